@@ -1,32 +1,66 @@
 import os
+import time
 from os import path as p
 
-import openai
+# Used to report the cold-start time to the first API request
+START_TIME = time.perf_counter()
+
 import logging
+from typing import TYPE_CHECKING
 
 # Set up root in ~/.gptdo
 ROOT = p.join(os.path.expanduser("~"), ".gptdo")
 
 logger = logging.getLogger("gptdo")
-handler = logging.FileHandler(p.join(ROOT, "log.txt"))
-formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-handler.setFormatter(formatter)
 
-from .chatbot import GPTDoChatbot
+# The chatbot is only imported once it is needed, so that a thin client of the daemon doesn't pay for it
+if TYPE_CHECKING:
+	from .chatbot import GPTDoChatbot
+
+_chat : 'GPTDoChatbot' = None
 
-_chat : GPTDoChatbot = None
+# Maximum number of tokens sent per completion, set to 0 for no limit
+DEFAULT_TOKEN_BUDGET = 32000
 
-def initialize(loglevel=0, auto_approve=False, raw=False, context_files : list=None):
+def _seconds(variable : str, default : float) -> float:
+	"""A duration setting, where 0 means no limit (None)"""
+	return float(os.getenv(variable, default)) or None
+
+def load_config() -> dict:
+	"""Reads the settings shared by every session from the environment and ~/.gptdo/.env"""
 	import dotenv
+	from . import cache, api, functions
+	from .executor import ResourceLimits
 
 	dotenv.load_dotenv(p.join(ROOT, ".env"), override=True)
 	API_KEY = os.getenv("OPENAI_API_KEY")
 	if not API_KEY:
 		raise Exception("OPENAI_API_KEY not set in environment or .env file (~/.gptdo/.env)")
-	
-	openai.api_key = API_KEY
-	gpt_model = os.getenv("GPT_MODEL", "gpt-4o-mini")
 
+	return {
+		"api_key": API_KEY,
+		"gpt_model": os.getenv("GPT_MODEL", "gpt-4o-mini"),
+		"token_budget": int(os.getenv("GPT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET)),
+		"cache_ttl": int(os.getenv("GPTDO_CACHE_TTL", cache.DEFAULT_TTL)),
+		"request_timeout": float(os.getenv("GPTDO_REQUEST_TIMEOUT", api.DEFAULT_READ_TIMEOUT)),
+		"max_retries": int(os.getenv("GPTDO_MAX_RETRIES", api.DEFAULT_MAX_RETRIES)),
+		"command_timeouts": {
+			functions.FUNC_RUN_COMMANDS_FOR_CONTEXT["name"]: (
+				_seconds("GPTDO_CONTEXT_COMMAND_TIMEOUT", functions.DEFAULT_CONTEXT_COMMAND_TIMEOUTS[0]),
+				_seconds("GPTDO_CONTEXT_COMMAND_IDLE_TIMEOUT", functions.DEFAULT_CONTEXT_COMMAND_TIMEOUTS[1]),
+			),
+			functions.FUNC_RUN_COMMANDS["name"]: (
+				_seconds("GPTDO_COMMAND_TIMEOUT", functions.DEFAULT_COMMAND_TIMEOUTS[0]),
+				_seconds("GPTDO_COMMAND_IDLE_TIMEOUT", functions.DEFAULT_COMMAND_TIMEOUTS[1]),
+			),
+		},
+		"resource_limits": ResourceLimits(
+			cpu_seconds=int(os.getenv("GPTDO_AUTO_APPROVE_CPU_LIMIT", 0)) or None,
+			memory_bytes=int(os.getenv("GPTDO_AUTO_APPROVE_MEMORY_LIMIT", 0)) * 1024 * 1024 or None,
+		),
+	}
+
+def setup_logging(loglevel=0):
 	log_level = logging.ERROR
 	if loglevel == 1:
 		log_level = logging.WARNING
@@ -39,15 +73,61 @@ def initialize(loglevel=0, auto_approve=False, raw=False, context_files : list=N
 		os.mkdir(ROOT)
 
 	# Configure logger to write to ROOT/log.txt, with prefix yyyy-mm-dd hh:mm:ss [LOGLEVEL]
-	
+	# The log file is only opened here, so that importing gptdo doesn't touch the filesystem
+	handler = logging.FileHandler(p.join(ROOT, "log.txt"))
+	handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
 	handler.setLevel(log_level)
 	logger.addHandler(handler)
 	logger.setLevel(log_level)
 
+def create_chatbot(config : dict, auto_approve=False, raw=False, context_files : list=None, stream=False, persistent_shell=False, use_cache=True, profile=False, resume : str=None, use_recipes=True, chatbot_class : type=None, **kwargs) -> 'GPTDoChatbot':
+	from . import cache, api, sessions, recipes
+	from .chatbot import GPTDoChatbot
+	chatbot_class = chatbot_class or GPTDoChatbot
+
+	# Raw prompts are answered from the response cache when possible (disabled if the TTL is 0)
+	response_cache = None
+	if raw and config["cache_ttl"] > 0:
+		response_cache = cache.ResponseCache(ttl=config["cache_ttl"])
+
+	# Recipes are offered interactively, which raw prompts can't be
+	recipe_index = recipes.RecipeIndex() if use_recipes and not raw else None
+
+	session, messages = None, []
+	if resume:
+		session, header, messages = sessions.resume(resume)
+		# The context files of the resumed session, unless others are given
+		context_files = context_files or header.get("context_files")
+		logger.info(f"Resuming session {session.id} ({len(messages)} messages)")
+
+	chatbot = chatbot_class(
+		gpt_model=config["gpt_model"], auto_approve=auto_approve, raw=raw, context_files=context_files, stream=stream, token_budget=config["token_budget"],
+		persistent_shell=persistent_shell, cache=response_cache, bypass_cache=not use_cache, api_key=config["api_key"], profile=profile, recipes=recipe_index,
+		command_timeouts=config.get("command_timeouts"), resource_limits=config.get("resource_limits"),
+		client=api.get_client(config["api_key"], read_timeout=config["request_timeout"], max_retries=config["max_retries"]), **kwargs
+	)
+
+	# One-off raw prompts aren't worth keeping
+	if session is None and not raw:
+		session = sessions.SessionLog.create(config["gpt_model"], context_files)
+
+	if session is not None:
+		chatbot.conversation.restore(messages)
+		chatbot.conversation.session = session
+
+	return chatbot
+
+def initialize(loglevel=0, auto_approve=False, raw=False, context_files : list=None, stream=False, persistent_shell=False, use_cache=True, profile=False, resume : str=None, use_recipes=True):
+	config = load_config()
+	setup_logging(loglevel)
+
 	# Initialialize the conversation
 	global _chat
 	
-	_chat = GPTDoChatbot(gpt_model=gpt_model, auto_approve=auto_approve, raw=raw, context_files=context_files)
+	_chat = create_chatbot(
+		config, auto_approve=auto_approve, raw=raw, context_files=context_files, stream=stream,
+		persistent_shell=persistent_shell, use_cache=use_cache, profile=profile, resume=resume, use_recipes=use_recipes
+	)
 
 def get_chat():
 	return _chat
@@ -2,21 +2,65 @@
 # Command line tool which allows you to type a prompt and get a recommended command to run, which you can approve to automatically run
 # Usage: gptdo -p ["prompt goes here"] [-y] [-h]
 
+import sys
 import argparse
 from shutil import get_terminal_size
 
-# Parse args
-parser = argparse.ArgumentParser()
-parser.add_argument("-p", "--prompt", help="Initial prompt to use", default=None, type=str)
-parser.add_argument("-F", "--context-file", help="Extra file or files to add to context", default=[], nargs='+')
-parser.add_argument("-r", "--raw", help="Output only raw commands which can be run directly in shell by piping or using $(gptdo -r -p 'prompt')", action="store_true", default=False)
-parser.add_argument("-y", "--yes", help="Automatically run the command", action="store_true", default=False)
-parser.add_argument("-v", "--verbose", help="Verbose level 0-3", default=3, type=int)
-parser.usage = "gptdo [-p \"prompt goes here\"] [-y]"
-args = parser.parse_args()
+def parse_args(argv : list=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-p", "--prompt", help="Initial prompt to use", default=None, type=str)
+	parser.add_argument("-F", "--context-file", help="Extra file or files to add to context", default=[], nargs='+')
+	parser.add_argument("-r", "--raw", help="Output only raw commands which can be run directly in shell by piping or using $(gptdo -r -p 'prompt')", action="store_true", default=False)
+	parser.add_argument("-y", "--yes", help="Automatically run the command", action="store_true", default=False)
+	parser.add_argument("-s", "--stream", help="Stream responses to the terminal as they are generated", action="store_true", default=False)
+	parser.add_argument("-P", "--persistent-shell", help="Run all commands in one long-lived shell, so that cd and exported variables carry over between commands", action="store_true", default=False)
+	parser.add_argument("--no-cache", help="With -r, always ask the API instead of reusing a cached response for the same prompt", action="store_true", default=False)
+	parser.add_argument("--no-recipes", help="Don't offer the commands saved for a similar earlier prompt, and don't save new ones", action="store_true", default=False)
+	parser.add_argument("--profile", help="Print how long each phase of every turn took (and the tokens used) on exit", action="store_true", default=False)
+	parser.add_argument("--batch", help="Get the commands for every prompt of a JSONL file, without running them", default=None, metavar="FILE")
+	parser.add_argument("-o", "--output", help="With --batch, the JSONL file results are appended to (default FILE.results.jsonl)", default=None)
+	parser.add_argument("-j", "--concurrency", help="With --batch, how many prompts are run at once", default=None, type=int)
+	parser.add_argument("--resume", help="Continue a previous session: the latest one, or the one with the given id (or id prefix)", default=None, nargs="?", const="latest", metavar="ID")
+	parser.add_argument("--sessions", help="List the saved sessions", action="store_true", default=False)
+	parser.add_argument("--prune-sessions", help="Delete the sessions not used for DAYS days (30 by default), and the oldest ones past 100MB in total", default=None, nargs="?", const=30, type=float, metavar="DAYS")
+	parser.add_argument("--daemon", help="Start a background process which serves later gptdo commands, keeping the API client and context warm", action="store_true", default=False)
+	parser.add_argument("--idle-timeout", help="Seconds without any session after which the daemon shuts down", default=None, type=float)
+	parser.add_argument("--stop-daemon", help="Stop the running daemon", action="store_true", default=False)
+	parser.add_argument("--no-daemon", help="Run in this process even if a daemon is running", action="store_true", default=False)
+	parser.add_argument("-v", "--verbose", help="Verbose level 0-3", default=3, type=int)
+	parser.usage = "gptdo [-p \"prompt goes here\"] [-y]"
+	return parser.parse_args(argv)
 
-def main():	
-	from . import initialize, get_chat
+def main():
+	# Parse args
+	args = parse_args()
+
+	if args.daemon or args.stop_daemon:
+		from . import daemon
+		if args.stop_daemon:
+			print("gptdo daemon stopped" if daemon.stop() else "gptdo daemon is not running")
+		else:
+			daemon.start(args.verbose, idle_timeout=args.idle_timeout or daemon.DEFAULT_IDLE_TIMEOUT)
+		return
+
+	if args.sessions or args.prune_sessions is not None:
+		from . import sessions
+		if args.prune_sessions is not None:
+			deleted = sessions.prune(max_age=args.prune_sessions * 24 * 60 * 60)
+			print(f"Deleted {len(deleted)} sessions ({sum(s['size'] for s in deleted) / 1024:.1f}KB)")
+		else:
+			print(sessions.format_sessions(sessions.list_sessions()) or "No saved sessions")
+		return
+
+	if args.batch:
+		from . import load_config, setup_logging, batch
+		config = load_config()
+		setup_logging(args.verbose)
+		try:
+			failed = batch.run(config, args.batch, output_path=args.output, concurrency=args.concurrency or batch.DEFAULT_CONCURRENCY, context_files=args.context_file, use_cache=not args.no_cache)
+		except KeyboardInterrupt:
+			exit(130)
+		exit(1 if failed else 0)
 
 	auto_approve = args.yes
 	raw_input = args.raw
@@ -27,16 +71,38 @@ def main():
 		if not args.prompt:
 			raise ValueError("Cannot use -r (raw output) without an in-line prompt")
 
-	initialize(args.verbose, auto_approve=auto_approve, raw=raw_input, context_files=context_files)
+	chatbot_options = dict(auto_approve=auto_approve, raw=raw_input, context_files=context_files, stream=args.stream, persistent_shell=args.persistent_shell, use_cache=not args.no_cache, profile=args.profile, resume=args.resume, use_recipes=not args.no_recipes)
 
 	# Get prompt
 	prompt = args.prompt
-	
+
 	try:
+		connection = None
+		if not args.no_daemon:
+			from .daemon import connect
+			connection = connect()
+
+		if connection is not None:
+			# A daemon is running, so this process is only a thin client for it
+			from .daemon import run_client
+			if not raw_input:
+				from . import history
+			exit(run_client(connection, prompt, chatbot_options))
+
+		# Only imported without a daemon, which a thin client doesn't need
+		from . import initialize, get_chat
+		from .exceptions import SessionNotFound
+		try:
+			initialize(args.verbose, **chatbot_options)
+		except SessionNotFound as e:
+			print(f"ERR: {e}", file=sys.stderr)
+			exit(1)
+
 		get_chat().start(prompt)
-	
+
 	except (EOFError, KeyboardInterrupt):
 		print("\rGoodbye!".ljust(get_terminal_size()[0]))
 		exit(0)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,197 @@
+import time
+import random
+import logging
+import threading
+from . import exceptions as gptdo_exc
+
+logger = logging.getLogger("gptdo")
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 4
+
+# Connections are kept alive between turns, which can be far apart while the user reads or approves commands
+MAX_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 120
+
+# Exponential backoff, with full jitter: attempt n sleeps a random time between 0 and min(BACKOFF_MAX, BACKOFF_BASE * 2^n)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# The circuit opens after this many consecutive failed attempts, and stays open for CIRCUIT_COOLDOWN seconds
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 30
+
+RETRYABLE_STATUS_CODES = { 408, 409, 429, 500, 502, 503, 504 }
+
+class CircuitBreaker:
+	"""Fails requests fast while the API is down, instead of making every request wait through its retries
+
+	After `threshold` consecutive failures the circuit opens, and requests fail straight away for `cooldown` seconds.
+	The first request after that is let through: the circuit closes again if it succeeds, or reopens if it fails.
+	"""
+	def __init__(self, threshold : int=CIRCUIT_FAILURE_THRESHOLD, cooldown : float=CIRCUIT_COOLDOWN):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.opened_at : float = None
+		self._lock = threading.Lock()
+
+	def check(self):
+		with self._lock:
+			if self.opened_at is None:
+				return
+
+			remaining = self.opened_at + self.cooldown - time.monotonic()
+			if remaining > 0:
+				raise gptdo_exc.CircuitOpen(f"The API failed {self.failures} times in a row, not retrying for another {remaining:.0f}s")
+
+			# Half-open: let this request through, and reopen straight away if it fails
+			self.opened_at = None
+			self.failures = self.threshold - 1
+
+	def record_success(self):
+		with self._lock:
+			self.failures = 0
+			self.opened_at = None
+
+	def record_failure(self):
+		with self._lock:
+			self.failures += 1
+			if self.failures >= self.threshold and self.opened_at is None:
+				logger.warning(f"Opening the API circuit breaker after {self.failures} consecutive failures")
+				self.opened_at = time.monotonic()
+
+
+class APIClient:
+	"""A configured OpenAI client, shared by every conversation in the process
+
+	It keeps a pool of keep-alive connections, applies connect and read timeouts, and retries requests which failed
+	on a timeout, a connection error, a 429 or a 5xx, with jittered exponential backoff (or as long as the API asks
+	for in `Retry-After`). A circuit breaker stops retrying while the API is consistently failing.
+
+	openai is only imported once the first request is sent.
+	"""
+	def __init__(self, api_key : str=None, connect_timeout : float=DEFAULT_CONNECT_TIMEOUT, read_timeout : float=DEFAULT_READ_TIMEOUT, max_retries : int=DEFAULT_MAX_RETRIES, breaker : CircuitBreaker=None):
+		self.api_key = api_key
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.max_retries = max_retries
+		self.breaker = breaker or CircuitBreaker()
+		self._client = None
+		self._lock = threading.Lock()
+
+	@property
+	def client(self):
+		with self._lock:
+			if self._client is None:
+				import openai
+				timeout = openai.Timeout(self.read_timeout, connect=self.connect_timeout)
+				# openai doesn't re-export its HTTP library's Limits, so the type is taken from its defaults
+				limits = type(openai.DEFAULT_CONNECTION_LIMITS)(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY)
+				self._client = openai.OpenAI(
+					api_key=self.api_key,
+					timeout=timeout,
+					# Retries are handled here, so that they can be counted and share the circuit breaker
+					max_retries=0,
+					http_client=openai.DefaultHttpxClient(timeout=timeout, limits=limits)
+				)
+
+			return self._client
+
+	def create(self, request : dict, stats : dict=None):
+		"""Sends a chat completion request, retrying it if needed
+
+		`stats` is updated with the number of retries and the total time spent backing off.
+		"""
+		import openai
+		client = self.client
+		if stats is None:
+			stats = {}
+		stats.setdefault("retries", 0)
+		stats.setdefault("backoff_time", 0.0)
+
+		attempt = 0
+		while True:
+			self.breaker.check()
+			try:
+				response = client.chat.completions.create(**request)
+				self.breaker.record_success()
+				return response
+			except openai.APIError as e:
+				if not _is_retryable(e):
+					raise
+
+				self.breaker.record_failure()
+				if attempt >= self.max_retries:
+					raise gptdo_exc.RequestFailed(f"Request failed after {attempt + 1} attempts: {e.__class__.__name__}: {e}") from e
+
+				delay = _retry_after(e)
+				if delay is None:
+					delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+				delay = min(delay, BACKOFF_MAX)
+				logger.warning(f"Request failed ({e.__class__.__name__}: {e}), retrying in {delay:.2f}s ({attempt + 1}/{self.max_retries})")
+				time.sleep(delay)
+
+				attempt += 1
+				stats["retries"] += 1
+				stats["backoff_time"] += delay
+
+	def stream(self, request : dict, stats : dict=None):
+		"""Yields the chunks of a streamed completion. Only starting the stream is retried, since chunks may already have been used"""
+		import openai
+		stream = self.create({ **request, "stream": True }, stats)
+		try:
+			yield from stream
+		except openai.APIError as e:
+			if not _is_retryable(e):
+				raise
+
+			self.breaker.record_failure()
+			raise gptdo_exc.RequestFailed(f"Streamed response was interrupted: {e.__class__.__name__}: {e}") from e
+
+
+def _is_retryable(error) -> bool:
+	import openai
+	if isinstance(error, openai.APIConnectionError):
+		# Includes timeouts
+		return True
+
+	return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+def _retry_after(error) -> float:
+	"""The delay the API asked for, in seconds, or None"""
+	response = getattr(error, "response", None)
+	if response is None:
+		return None
+
+	headers = response.headers
+	try:
+		if "retry-after-ms" in headers:
+			return float(headers["retry-after-ms"]) / 1000
+
+		if "retry-after" in headers:
+			value = headers["retry-after"]
+			try:
+				return float(value)
+			except ValueError:
+				# Only HTTP dates need parsing, which is rare enough not to import email.utils on every start
+				from email.utils import parsedate_to_datetime
+				return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+	except (TypeError, ValueError):
+		pass
+
+	return None
+
+_clients : 'dict[tuple, APIClient]' = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key : str, read_timeout : float=DEFAULT_READ_TIMEOUT, max_retries : int=DEFAULT_MAX_RETRIES) -> APIClient:
+	"""Returns the process-wide client for these settings, so that its connections and circuit breaker are shared"""
+	key = (api_key, read_timeout, max_retries)
+	with _clients_lock:
+		if key not in _clients:
+			_clients[key] = APIClient(api_key=api_key, read_timeout=read_timeout, max_retries=max_retries)
+
+		return _clients[key]
@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger("gptdo")
+
+DEFAULT_CONCURRENCY = 4
+
+def default_output_path(input_path : str) -> str:
+	root, _ = os.path.splitext(input_path)
+	return root + ".results.jsonl"
+
+def read_prompts(path : str) -> 'list[dict]':
+	"""Reads one prompt per line: `{"prompt": ..., "id": ..., "context_files": [...]}`, where only the prompt is required
+
+	Prompts without an id are identified by their line number.
+	"""
+	prompts = []
+	with open(path, "r") as f:
+		for line_number, line in enumerate(f, start=1):
+			line = line.strip()
+			if not line:
+				continue
+
+			entry = json.loads(line)
+			if isinstance(entry, str):
+				entry = { "prompt": entry }
+
+			if not entry.get("prompt"):
+				raise ValueError(f"{path}:{line_number}: missing prompt")
+
+			entry.setdefault("id", str(line_number))
+			prompts.append(entry)
+
+	return prompts
+
+def read_completed(path : str) -> 'set[str]':
+	"""The ids of the prompts which already have a successful result in `path`, from an earlier (maybe interrupted) run"""
+	completed = set()
+	if not os.path.exists(path):
+		return completed
+
+	with open(path, "r") as f:
+		for line in f:
+			try:
+				result = json.loads(line)
+			except json.JSONDecodeError:
+				# The last line of an interrupted run may be incomplete
+				continue
+
+			if not result.get("error"):
+				completed.add(str(result["id"]))
+
+	return completed
+
+def run_prompt(config : dict, entry : dict, context_files : list=None, use_cache : bool=True) -> dict:
+	"""Asks for the commands for a single prompt, in raw mode, without running anything"""
+	from . import create_chatbot
+
+	context_files = (context_files or []) + entry.get("context_files", [])
+	start = time.perf_counter()
+	result = { "id": entry["id"], "prompt": entry["prompt"] }
+
+	chatbot = None
+	try:
+		chatbot = create_chatbot(config, auto_approve=True, raw=True, context_files=context_files or None, use_cache=use_cache)
+		chatbot.conversation.add_user_message(entry["prompt"])
+		completion = chatbot.generate_completion()
+
+		message = completion.choices[0].message
+		result["commands"] = [command for call in message.tool_calls or [] for command in json.loads(call.function.arguments).get("commands", [])]
+		result["content"] = message.content
+		if not result["commands"]:
+			result["error"] = "No commands were recommended."
+
+		usage = getattr(completion, "usage", None)
+		result["prompt_tokens"] = usage.prompt_tokens if usage else None
+		result["completion_tokens"] = usage.completion_tokens if usage else None
+		# Completions answered from the response cache don't record any turn
+		result["cached"] = not chatbot.turn_metrics
+		result["retries"] = sum(m["retries"] for m in chatbot.turn_metrics)
+
+	except Exception as e:
+		logger.warning(f"Batch prompt {entry['id']} failed: {e.__class__.__name__}: {e}")
+		result["error"] = f"{e.__class__.__name__}: {e}"
+
+	finally:
+		if chatbot is not None and chatbot.cache is not None:
+			chatbot.cache.close()
+
+	result["latency"] = time.perf_counter() - start
+	return result
+
+def run(config : dict, input_path : str, output_path : str=None, concurrency : int=DEFAULT_CONCURRENCY, context_files : list=None, use_cache : bool=True) -> int:
+	"""Runs every prompt of `input_path` which doesn't have a result yet, appending results to `output_path` as they complete
+
+	Returns the number of prompts which failed.
+	"""
+	output_path = output_path or default_output_path(input_path)
+	prompts = read_prompts(input_path)
+	completed = read_completed(output_path)
+	pending = [entry for entry in prompts if str(entry["id"]) not in completed]
+
+	print(f"{len(prompts)} prompts, {len(prompts) - len(pending)} already done, running {len(pending)} with concurrency {concurrency} -> {output_path}", file=sys.stderr)
+	logger.info(f"Batch run of {input_path}: {len(pending)}/{len(prompts)} prompts, concurrency {concurrency}")
+
+	start = time.perf_counter()
+	failed = 0
+	done = 0
+
+	pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="gptdo-batch")
+	try:
+		with open(output_path, "a") as output:
+			futures = [pool.submit(run_prompt, config, entry, context_files=context_files, use_cache=use_cache) for entry in pending]
+			for future in as_completed(futures):
+				result = future.result()
+				# Results are written in the order they complete, a line at a time, so an interrupted run loses nothing
+				output.write(json.dumps(result) + "\n")
+				output.flush()
+
+				done += 1
+				if result.get("error"):
+					failed += 1
+
+				print(f"[{done}/{len(pending)}] {result['id']}: {'FAILED' if result.get('error') else 'ok'} ({result['latency']:.2f}s)", file=sys.stderr)
+	except KeyboardInterrupt:
+		pool.shutdown(wait=False, cancel_futures=True)
+		print(f"Interrupted after {done}/{len(pending)} prompts, run again to resume", file=sys.stderr)
+		raise
+	finally:
+		pool.shutdown(wait=False)
+
+	elapsed = time.perf_counter() - start
+	print(f"Finished {done} prompts in {elapsed:.1f}s ({failed} failed)", file=sys.stderr)
+	logger.info(f"Batch run finished: {done} prompts in {elapsed:.1f}s, {failed} failed")
+	return failed
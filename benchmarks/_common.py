@@ -0,0 +1,32 @@
+"""Shared helpers for the benchmark scripts in this directory
+
+The benchmarks are run as plain scripts (e.g. `python benchmarks/bench_executor.py`) from a checkout of the repository,
+so the repository itself has to be imported as a package by its directory name.
+"""
+import os
+import sys
+import json
+import importlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_NAME = os.path.basename(REPO_DIR)
+
+def import_gptdo(submodule : str=None):
+	# gptdo logs to ~/.gptdo/log.txt, which has to exist before it is imported
+	os.makedirs(os.path.join(os.path.expanduser("~"), ".gptdo"), exist_ok=True)
+
+	if os.path.dirname(REPO_DIR) not in sys.path:
+		sys.path.insert(0, os.path.dirname(REPO_DIR))
+
+	name = PACKAGE_NAME if submodule is None else f"{PACKAGE_NAME}.{submodule}"
+	return importlib.import_module(name)
+
+def write_results(results : dict, path : str=None):
+	"""Prints the results as JSON, or writes them to `path` if given"""
+	output = json.dumps(results, indent=4)
+	if path is None:
+		print(output)
+		return
+
+	with open(path, "w") as f:
+		f.write(output + "\n")
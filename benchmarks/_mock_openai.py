@@ -0,0 +1,114 @@
+"""A local stand-in for the chat completions endpoint, for benchmarking gptdo without the API
+
+Each request is answered with the next scripted response: `{"content": ...}` and/or
+`{"tool_calls": [{"name": ..., "arguments": ...}, ...]}`. Streamed requests get the response as server-sent events,
+split into chunks. `latency` is added before every response and `chunk_delay` between streamed chunks.
+"""
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_RESPONSE = { "content": "Done." }
+
+class MockOpenAI:
+	def __init__(self, latency : float=0.0, chunk_delay : float=0.0, chunk_size : int=8):
+		self.latency = latency
+		self.chunk_delay = chunk_delay
+		self.chunk_size = chunk_size
+		self.responses : 'list[dict]' = []
+		# Size in bytes of each request body received, in order
+		self.request_sizes : 'list[int]' = []
+		self._lock = threading.Lock()
+		self._server : ThreadingHTTPServer = None
+
+	@property
+	def base_url(self) -> str:
+		host, port = self._server.server_address[:2]
+		return f"http://{host}:{port}/v1"
+
+	def script(self, responses : 'list[dict]'):
+		with self._lock:
+			self.responses.extend(responses)
+
+	def start(self) -> 'MockOpenAI':
+		mock = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def log_message(self, *args):
+				pass
+
+			def do_POST(self):
+				body = self.rfile.read(int(self.headers["Content-Length"]))
+				with mock._lock:
+					mock.request_sizes.append(len(body))
+					response = mock.responses.pop(0) if mock.responses else DEFAULT_RESPONSE
+
+				time.sleep(mock.latency)
+				if json.loads(body).get("stream"):
+					mock._stream(self, response)
+				else:
+					mock._respond(self, response)
+
+		self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		threading.Thread(target=self._server.serve_forever, daemon=True).start()
+		return self
+
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+	def _usage(self, response : dict) -> dict:
+		completion_tokens = len(json.dumps(response)) // 4
+		return { "prompt_tokens": 0, "completion_tokens": completion_tokens, "total_tokens": completion_tokens }
+
+	def _respond(self, handler : BaseHTTPRequestHandler, response : dict):
+		message = { "role": "assistant", "content": response.get("content") }
+		tool_calls = response.get("tool_calls")
+		if tool_calls:
+			message["tool_calls"] = [{ "id": f"call_{i}", "type": "function", "function": call } for i, call in enumerate(tool_calls)]
+
+		data = json.dumps({
+			"id": "mock", "object": "chat.completion", "created": int(time.time()), "model": "mock",
+			"choices": [{ "index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop" }],
+			"usage": self._usage(response),
+		}).encode("utf-8")
+
+		handler.send_response(200)
+		handler.send_header("Content-Type", "application/json")
+		handler.send_header("Content-Length", str(len(data)))
+		handler.end_headers()
+		handler.wfile.write(data)
+
+	def _stream(self, handler : BaseHTTPRequestHandler, response : dict):
+		handler.send_response(200)
+		handler.send_header("Content-Type", "text/event-stream")
+		handler.end_headers()
+
+		def send(delta : dict=None, finish_reason : str=None, usage : dict=None):
+			chunk = {
+				"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": "mock",
+				"choices": [{ "index": 0, "delta": delta, "finish_reason": finish_reason }] if delta is not None else [],
+				"usage": usage,
+			}
+			handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+			handler.wfile.flush()
+			time.sleep(self.chunk_delay)
+
+		content = response.get("content") or ""
+		for i in range(0, len(content), self.chunk_size):
+			send({ "content": content[i:i + self.chunk_size] })
+
+		tool_calls = response.get("tool_calls") or []
+		for index, call in enumerate(tool_calls):
+			send({ "tool_calls": [{ "index": index, "id": f"call_{index}", "type": "function", "function": { "name": call["name"], "arguments": "" } }] })
+			arguments = call["arguments"]
+			for i in range(0, len(arguments), self.chunk_size):
+				send({ "tool_calls": [{ "index": index, "function": { "arguments": arguments[i:i + self.chunk_size] } }] })
+
+		send({}, finish_reason="tool_calls" if tool_calls else "stop")
+		send(usage=self._usage(response))
+		handler.wfile.write(b"data: [DONE]\n\n")
+		handler.wfile.flush()
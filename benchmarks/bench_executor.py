@@ -0,0 +1,55 @@
+"""Compares the per-command overhead of a new bash process per command with the persistent shell session
+
+Usage: python benchmarks/bench_executor.py [-n ITERATIONS] [-o OUTPUT.json]
+"""
+import time
+import argparse
+import statistics
+from _common import import_gptdo, write_results
+
+COMMANDS = {
+	"true": "true",
+	"echo": "echo hello",
+	"pipeline": "seq 1 1000 | grep 7 | wc -l",
+}
+
+def bench(run, command : str, iterations : int) -> dict:
+	timings = []
+	for _ in range(iterations):
+		start = time.perf_counter()
+		result = run(command)
+		timings.append(time.perf_counter() - start)
+		assert result.exit_code == 0, f"{command} failed with exit code {result.exit_code}"
+
+	return {
+		"mean_ms": statistics.mean(timings) * 1000,
+		"median_ms": statistics.median(timings) * 1000,
+		"p95_ms": sorted(timings)[int(len(timings) * 0.95)] * 1000,
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-n", "--iterations", default=200, type=int)
+	parser.add_argument("-o", "--output", default=None)
+	args = parser.parse_args()
+
+	executor = import_gptdo("executor")
+	session = executor.ShellSession()
+
+	results = {}
+	try:
+		for name, command in COMMANDS.items():
+			popen = bench(executor.run_process, command, args.iterations)
+			persistent = bench(session.run, command, args.iterations)
+			results[name] = {
+				"popen": popen,
+				"persistent_shell": persistent,
+				"speedup": popen["mean_ms"] / persistent["mean_ms"],
+			}
+	finally:
+		session.close()
+
+	write_results({ "iterations": args.iterations, "results": results }, args.output)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,94 @@
+"""Guards the startup cost of gptdo: the time to import everything needed before the first prompt
+
+Runs a fresh interpreter with `-X importtime` several times, and reports the median import time of the package and its
+slowest imports. Exits with a non-zero code if the median is over the budget, or if any of the heavy modules which
+should only be imported on first use (openai, pydantic, readline...) were imported at startup.
+
+Usage: python benchmarks/bench_startup.py [-n RUNS] [--budget-ms MS] [-o OUTPUT.json]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from _common import REPO_DIR, PACKAGE_NAME, write_results
+
+# Modules which must not be imported until they are first needed
+DEFERRED_MODULES = ["openai", "pydantic", "httpx", "readline", "dotenv", "tiktoken", "sqlite3"]
+
+DEFAULT_BUDGET_MS = 100
+
+# Everything imported before the first prompt
+STARTUP_MODULES = [PACKAGE_NAME, f"{PACKAGE_NAME}.__main__", f"{PACKAGE_NAME}.functions"]
+
+STARTUP_SCRIPT = f"""
+import sys, time, importlib
+sys.path.insert(0, {os.path.dirname(REPO_DIR)!r})
+start = time.perf_counter()
+for module in {STARTUP_MODULES!r}:
+	importlib.import_module(module)
+print((time.perf_counter() - start) * 1000)
+print(",".join(sorted(m for m in sys.modules if m.split(".")[0] in {DEFERRED_MODULES!r})))
+"""
+
+def parse_importtime(stderr : str) -> 'dict[str, int]':
+	"""Returns the cumulative import time (in microseconds) of each module"""
+	timings = {}
+	for line in stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+
+		_, cumulative, name = line[len("import time:"):].split("|")
+		timings[name.strip()] = int(cumulative)
+
+	return timings
+
+def run_once() -> dict:
+	start = time.perf_counter()
+	process = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT], capture_output=True, text=True, check=True)
+	wall_time = time.perf_counter() - start
+
+	import_time, deferred_imported = (process.stdout.splitlines() + [""])[:2]
+
+	return {
+		"wall_time_ms": wall_time * 1000,
+		"import_time_ms": float(import_time),
+		"timings": parse_importtime(process.stderr),
+		"deferred_imported": [m for m in deferred_imported.split(",") if m],
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-n", "--runs", default=10, type=int)
+	parser.add_argument("--budget-ms", default=DEFAULT_BUDGET_MS, type=float)
+	parser.add_argument("-o", "--output", default=None)
+	args = parser.parse_args()
+
+	runs = [run_once() for _ in range(args.runs)]
+	import_time = statistics.median(r["import_time_ms"] for r in runs)
+	wall_time = statistics.median(r["wall_time_ms"] for r in runs)
+
+	last = runs[-1]["timings"]
+	slowest = sorted(last.items(), key=lambda item: item[1], reverse=True)[:15]
+	deferred_imported = sorted(set(m for r in runs for m in r["deferred_imported"]))
+
+	write_results({
+		"runs": args.runs,
+		"budget_ms": args.budget_ms,
+		"median_import_time_ms": import_time,
+		"median_wall_time_ms": wall_time,
+		"slowest_imports_ms": { name: us / 1000 for name, us in slowest },
+		"deferred_modules_imported": deferred_imported,
+	}, args.output)
+
+	if deferred_imported:
+		print(f"FAIL: modules which should be imported lazily were imported at startup: {', '.join(deferred_imported)}", file=sys.stderr)
+		sys.exit(1)
+
+	if import_time > args.budget_ms:
+		print(f"FAIL: median import time {import_time:.1f}ms is over the {args.budget_ms:.0f}ms budget", file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,201 @@
+"""Measures gptdo's own overhead over multi-turn conversations, against a local mock of the chat completions API
+
+Each scenario is a list of user prompts, with the scripted responses (function calls and messages) the mock answers
+them with. Every prompt is sent through `GPTDoChatbot.process_input`, so commands are really run (they are all
+read-only), and each turn's wall time is split between the API, the commands and gptdo itself.
+
+Usage: python benchmarks/bench_turns.py [-n REPETITIONS] [--latency SECONDS] [--chunk-delay SECONDS] [-o OUTPUT.json]
+"""
+import os
+import json
+import time
+import argparse
+import statistics
+from _common import import_gptdo, write_results
+from _mock_openai import MockOpenAI
+
+def run_commands(*commands : str, for_context : bool=False, stream_stdout_to_user : bool=False) -> dict:
+	return {
+		"name": "run_commands_to_gain_context" if for_context else "run_commands",
+		"arguments": json.dumps({ "stream_stdout_to_user": stream_stdout_to_user, "commands": list(commands) }),
+	}
+
+def tool_calls(*calls : dict) -> dict:
+	return { "tool_calls": list(calls) }
+
+def message(content : str) -> dict:
+	return { "content": content }
+
+SCENARIOS = {
+	"chat": [
+		("What does `tar -xzf` do?", [message("It extracts (x) a gzip-compressed (z) archive from the given file (f).")]),
+		("And to create one?", [message("Use `tar -czf archive.tar.gz <files>`: c creates, z compresses and f names the archive.")]),
+		("Thanks!", [message("You're welcome!")]),
+	],
+	"commands": [
+		("What's in this directory?", [
+			tool_calls(run_commands("ls -la", "pwd", "uname -a", for_context=True)),
+			message("This is a git checkout of gptdo, with its Python modules and benchmarks."),
+		]),
+		("How big is it?", [
+			tool_calls(run_commands("du -sh .", stream_stdout_to_user=True)),
+			message("See above."),
+		]),
+		("Which Python files are the largest?", [
+			tool_calls(run_commands("ls -S *.py | head -3", "wc -l *.py | tail -1", for_context=True)),
+			tool_calls(run_commands("wc -c $(ls -S *.py | head -3)", stream_stdout_to_user=True)),
+			message("Those are the three largest modules."),
+		]),
+	],
+	# The same discovery as one tool call per response, or as parallel tool calls in a single response
+	"discovery_sequential": [
+		("What is this project, and what state is it in?", [
+			tool_calls(run_commands("ls -la", for_context=True)),
+			tool_calls(run_commands("git log --oneline -5", for_context=True)),
+			tool_calls(run_commands("git status --short | head -20", for_context=True)),
+			message("A Python package, with a few uncommitted changes."),
+		]),
+	],
+	"discovery_parallel": [
+		("What is this project, and what state is it in?", [
+			tool_calls(
+				run_commands("ls -la", for_context=True),
+				run_commands("git log --oneline -5", for_context=True),
+				run_commands("git status --short | head -20", for_context=True),
+			),
+			message("A Python package, with a few uncommitted changes."),
+		]),
+	],
+}
+
+def percentile(values : 'list[float]', p : float) -> float:
+	return sorted(values)[min(int(len(values) * p), len(values) - 1)]
+
+def summarize(values : 'list[float]') -> dict:
+	return {
+		"mean_ms": statistics.mean(values) * 1000,
+		"median_ms": statistics.median(values) * 1000,
+		"p95_ms": percentile(values, 0.95) * 1000,
+	}
+
+def bench_context(context) -> dict:
+	context.invalidate_providers()
+	start = time.perf_counter()
+	context._generate_context()
+	cold = time.perf_counter() - start
+
+	start = time.perf_counter()
+	context._generate_context()
+	warm = time.perf_counter() - start
+
+	providers = {}
+	for name, provider in context.PROVIDERS.items():
+		start = time.perf_counter()
+		try:
+			provider.generate()
+		except Exception:
+			pass
+		providers[name] = (time.perf_counter() - start) * 1000
+
+	sections = { name: stats["tokens"] for name, stats in context.get_provider_stats().items() }
+	return { "cold_ms": cold * 1000, "warm_ms": warm * 1000, "providers_ms": providers, "sections_tokens": sections }
+
+def bench_scenario(chatbot_class, client, mock : MockOpenAI, turns : list, stream : bool, repetitions : int) -> dict:
+	setup, wall, api, commands, overhead, command_times, round_trips = [], [], [], [], [], [], []
+	requests = 0
+	request_bytes = []
+
+	for _ in range(repetitions):
+		start = time.perf_counter()
+		chatbot = chatbot_class(gpt_model="mock", auto_approve=True, stream=stream, client=client)
+		chatbot.inline_prompt = True
+		setup.append(time.perf_counter() - start)
+
+		for prompt, responses in turns:
+			mock.script(responses)
+			turn_count, command_count, request_count = len(chatbot.turn_metrics), len(chatbot.command_metrics), len(mock.request_sizes)
+			function_time = chatbot.function_time
+
+			start = time.perf_counter()
+			chatbot.process_input(prompt)
+			elapsed = time.perf_counter() - start
+
+			turn_api = sum(m["latency"] for m in chatbot.turn_metrics[turn_count:])
+			# Commands streamed in are run while the rest of the response is still being received, and so count as API time
+			turn_commands = chatbot.function_time - function_time
+			wall.append(elapsed)
+			api.append(turn_api)
+			commands.append(turn_commands)
+			overhead.append(elapsed - turn_api - turn_commands)
+			command_times += [m["wall_time"] for m in chatbot.command_metrics[command_count:]]
+			round_trips.append(chatbot.task_metrics[-1]["round_trips"])
+
+			requests += len(mock.request_sizes) - request_count
+			request_bytes += mock.request_sizes[request_count:]
+
+	return {
+		"repetitions": repetitions,
+		"stream": stream,
+		"setup": summarize(setup),
+		"turn_wall": summarize(wall),
+		"turn_api": summarize(api),
+		"turn_function_calls": summarize(commands),
+		"turn_overhead": summarize(overhead),
+		"command_wall": summarize(command_times) if command_times else None,
+		"requests": requests,
+		"round_trips_per_task": statistics.mean(round_trips),
+		"request_bytes": {
+			"mean": statistics.mean(request_bytes),
+			"max": max(request_bytes),
+		},
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-n", "--repetitions", default=5, type=int)
+	parser.add_argument("--latency", help="Seconds the mock API waits before each response", default=0.05, type=float)
+	parser.add_argument("--chunk-delay", help="Seconds between streamed chunks", default=0.002, type=float)
+	parser.add_argument("-o", "--output", default=None)
+	args = parser.parse_args()
+
+	mock = MockOpenAI(latency=args.latency, chunk_delay=args.chunk_delay).start()
+	# Must be set before the client is created, which reads it
+	os.environ["OPENAI_BASE_URL"] = mock.base_url
+
+	chatbot = import_gptdo("chatbot")
+	api = import_gptdo("api")
+	context = import_gptdo("context")
+
+	class QuietChatbot(chatbot.GPTDoChatbot):
+		"""Discards terminal output, and times tool calls, whose commands may run concurrently"""
+		function_time = 0.0
+
+		def write(self, text : str, stream : str="stdout"):
+			pass
+
+		def process_tool_calls(self, tool_calls):
+			start = time.perf_counter()
+			try:
+				return super().process_tool_calls(tool_calls)
+			finally:
+				self.function_time += time.perf_counter() - start
+
+	# One client for every run, as in a real session (and the daemon)
+	client = api.APIClient(api_key="mock")
+	# Importing openai and opening the first connection is a one-off cost, which would skew the first turn
+	client.create({ "model": "mock", "messages": [{ "role": "user", "content": "warm up" }] })
+	mock.request_sizes.clear()
+
+	results = { "context": bench_context(context), "scenarios": {} }
+	try:
+		for name, turns in SCENARIOS.items():
+			for stream in [False, True]:
+				key = name + ("_streamed" if stream else "")
+				results["scenarios"][key] = bench_scenario(QuietChatbot, client, mock, turns, stream, args.repetitions)
+	finally:
+		mock.stop()
+
+	write_results({ "latency": args.latency, "chunk_delay": args.chunk_delay, **results }, args.output)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from . import ROOT
+
+logger = logging.getLogger("gptdo")
+
+CACHE_PATH = os.path.join(ROOT, "cache.sqlite")
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+
+class ResponseCache:
+	"""A content-addressed, on-disk cache of completions, used to answer repeated raw (-r) prompts without the API
+
+	Entries are keyed on the model, the normalized conversation (without the system prompt) and the stable parts of the
+	context. They expire after `ttl` seconds, and the least recently used entries are evicted once the cache holds more
+	than `max_entries` entries or `max_bytes` bytes.
+	"""
+	def __init__(self, path : str=CACHE_PATH, ttl : float=DEFAULT_TTL, max_entries : int=DEFAULT_MAX_ENTRIES, max_bytes : int=DEFAULT_MAX_BYTES):
+		self.path = path
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self._db : sqlite3.Connection = None
+
+	@property
+	def db(self) -> sqlite3.Connection:
+		if self._db is None:
+			self._db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+			self._db.execute("PRAGMA journal_mode=WAL")
+			self._db.execute("""
+				CREATE TABLE IF NOT EXISTS completions (
+					key TEXT PRIMARY KEY,
+					value TEXT NOT NULL,
+					size INTEGER NOT NULL,
+					created REAL NOT NULL,
+					last_access REAL NOT NULL
+				)
+			""")
+			self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+
+		return self._db
+
+	@staticmethod
+	def key(model : str, messages : 'list[dict]', stable_context : str) -> str:
+		normalized = [
+			{
+				"role": m["role"],
+				"name": m.get("name"),
+				"content": " ".join((m.get("content") or "").split()),
+			}
+			for m in messages if m["role"] != "system"
+		]
+
+		payload = json.dumps([model, normalized, stable_context], sort_keys=True)
+		return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+	def get(self, key : str) -> str:
+		now = time.time()
+		row = self.db.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+		if row is None:
+			return None
+
+		value, created = row
+		if now - created > self.ttl:
+			self.db.execute("DELETE FROM completions WHERE key = ?", (key,))
+			return None
+
+		self.db.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+		return value
+
+	def put(self, key : str, value : str):
+		now = time.time()
+		self.db.execute(
+			"INSERT OR REPLACE INTO completions (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+			(key, value, len(value.encode("utf-8")), now, now)
+		)
+		self.evict()
+
+	def evict(self):
+		db = self.db
+		db.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.ttl,))
+
+		count, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+		if count <= self.max_entries and size <= self.max_bytes:
+			return
+
+		# Walk from the most recently used entry, and drop everything past the limits
+		kept_count = kept_size = 0
+		evicted = []
+		for key, entry_size in db.execute("SELECT key, size FROM completions ORDER BY last_access DESC").fetchall():
+			if kept_count + 1 > self.max_entries or kept_size + entry_size > self.max_bytes:
+				evicted.append((key,))
+				continue
+
+			kept_count += 1
+			kept_size += entry_size
+
+		db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+		logger.debug(f"Evicted {len(evicted)} cached completions")
+
+	def close(self):
+		if self._db is not None:
+			self._db.close()
+			self._db = None
@@ -0,0 +1,184 @@
+import os
+import re
+import time
+import shutil
+import hashlib
+import logging
+import itertools
+import threading
+from collections import deque
+from . import ROOT
+
+logger = logging.getLogger("gptdo")
+
+OUTPUT_DIR = os.path.join(ROOT, "outputs")
+
+# Characters of output kept in memory (and shown to the model) from the start and the end of each stream
+DEFAULT_HEAD_CHARS = 4000
+DEFAULT_TAIL_CHARS = 4000
+
+# Spilled output from sessions older than this is deleted
+MAX_SPILL_AGE = 24 * 60 * 60
+
+SESSION_ID = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+# Outputs are numbered across the process, and after those referenced by a restored session (see reserve_ids)
+_last_id = 0
+_ids_lock = threading.Lock()
+
+class OutputCapture:
+	"""Captures a stream of command output with bounded memory
+
+	Output is kept in memory until it grows past `head_chars + tail_chars`. From then on, only the head and a ring of
+	the most recent `tail_chars` are kept, and the full stream is spilled to a file under ~/.gptdo/outputs which the
+	model can page through with the `read_command_output` function. The whole stream is hashed as it is written, so
+	that identical outputs can be recognized (see outputs.py) even once truncated.
+	"""
+	def __init__(self, name : str, head_chars : int=DEFAULT_HEAD_CHARS, tail_chars : int=DEFAULT_TAIL_CHARS):
+		self.id = _next_id()
+		self.name = name
+		self.head_chars = head_chars
+		self.tail_chars = tail_chars
+
+		self.bytes = 0
+		self.lines = 0
+		self.path : str = None
+		self._hash = hashlib.sha256()
+
+		self._chunks : 'list[str]' = []
+		self._chars = 0
+		self._head = ""
+		self._tail : 'deque[str]' = deque()
+		self._tail_chars = 0
+		self._file = None
+
+	@property
+	def digest(self) -> str:
+		return self._hash.hexdigest()
+
+	@property
+	def truncated(self) -> bool:
+		return self.path is not None
+
+	@property
+	def readable(self) -> bool:
+		"""Whether the full output can still be read, which it can't once its spill file has been pruned"""
+		return not self.truncated or os.path.exists(self.path)
+
+	def write(self, text : str):
+		if not text:
+			return
+
+		data = text.encode("utf-8", errors="replace")
+		self.bytes += len(data)
+		self._hash.update(data)
+		self.lines += text.count("\n")
+
+		if self._file is None:
+			self._chunks.append(text)
+			self._chars += len(text)
+			if self._chars > self.head_chars + self.tail_chars:
+				self._spill()
+			return
+
+		self._file.write(text)
+		self._tail.append(text)
+		self._tail_chars += len(text)
+		while self._tail_chars - len(self._tail[0]) >= self.tail_chars:
+			self._tail_chars -= len(self._tail.popleft())
+
+	def _spill(self):
+		session_dir = os.path.join(OUTPUT_DIR, SESSION_ID)
+		if not os.path.exists(session_dir):
+			_prune_old_sessions()
+			os.makedirs(session_dir, exist_ok=True)
+
+		content = "".join(self._chunks)
+		self.path = os.path.join(session_dir, f"{self.id}-{self.name}.log")
+		self._file = open(self.path, "w", encoding="utf-8", errors="replace")
+		self._file.write(content)
+
+		self._head = content[:self.head_chars]
+		self._tail = deque([content[-self.tail_chars:]])
+		self._tail_chars = len(self._tail[0])
+		self._chunks = []
+
+		logger.debug(f"Spilled {self.name} output #{self.id} to {self.path}")
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+
+	def text(self) -> str:
+		"""The output as shown to the model: in full if it was small, otherwise its head and tail"""
+		if not self.truncated:
+			return "".join(self._chunks)
+
+		tail = "".join(self._tail)[-self.tail_chars:]
+		return (
+			f"{self._head}\n"
+			f"[... {self.name} truncated: {self.bytes} bytes / {self.lines} lines in total, showing the first {len(self._head)} "
+			f"and last {len(tail)} characters. Call `read_command_output` with output_id={self.id} to page through or search the full output ...]\n"
+			f"{tail}"
+		)
+
+	def read(self, offset : int=0, limit : int=100, pattern : str=None) -> str:
+		"""Returns `limit` lines of the full output starting from line `offset`, or of the lines matching `pattern`"""
+		if not self.truncated:
+			lines = enumerate("".join(self._chunks).splitlines())
+		else:
+			if not self._file.closed:
+				self._file.flush()
+			lines = enumerate(_read_lines(self.path))
+
+		if pattern:
+			regex = re.compile(pattern)
+			lines = ((i, line) for i, line in lines if regex.search(line))
+
+		selected = list(itertools.islice(lines, offset, offset + limit))
+		output = "\n".join(f"{i + 1}: {line}" for i, line in selected)[:self.head_chars + self.tail_chars]
+
+		return f"Output #{self.id} ({self.name}, {self.lines} lines), {'matches' if pattern else 'lines'} {offset} to {offset + len(selected)}:\n{output}"
+
+def _next_id() -> int:
+	global _last_id
+	with _ids_lock:
+		_last_id += 1
+		return _last_id
+
+# How outputs are referred to in what is sent to the model, e.g. "[stdout identical to output #3]"
+OUTPUT_REFERENCE = re.compile(r"[Oo]utput #(\d+)|output_id=(\d+)")
+
+def reserve_ids(text : str):
+	"""Numbers new outputs after those referenced in `text`, so that references from a restored session stay unambiguous"""
+	global _last_id
+	referenced = [int(a or b) for a, b in OUTPUT_REFERENCE.findall(text)]
+	with _ids_lock:
+		_last_id = max([_last_id] + referenced)
+
+def _read_lines(path : str):
+	with open(path, "r", encoding="utf-8", errors="replace") as f:
+		for line in f:
+			yield line.rstrip("\n")
+
+def _prune_old_sessions():
+	if not os.path.exists(OUTPUT_DIR):
+		return
+
+	for session in os.listdir(OUTPUT_DIR):
+		session_dir = os.path.join(OUTPUT_DIR, session)
+		try:
+			if time.time() - os.path.getmtime(session_dir) > MAX_SPILL_AGE:
+				shutil.rmtree(session_dir, ignore_errors=True)
+		except OSError:
+			pass
+
+def read_command_output(output_id : int, offset : int=0, limit : int=100, pattern : str=None, capture : OutputCapture=None) -> str:
+	"""Reads `capture`, the output numbered `output_id` in the session asking for it (see OutputStore.get)"""
+	if capture is None:
+		return f"No output with output_id={output_id} exists. Only outputs which were truncated, or numbered, can be read."
+
+	try:
+		return capture.read(offset=offset, limit=limit, pattern=pattern)
+	except re.error as e:
+		return f"Invalid pattern {pattern!r}: {e}"
@@ -2,122 +2,478 @@ import sys
 import time
 import json
 import logging
-import openai
-from openai.types.chat import ChatCompletion
-from openai.types.chat.chat_completion_message import FunctionCall
-from . import util
+import threading
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+from . import util, tracing, exceptions as gptdo_exc
+from .api import APIClient
+from .jsonstream import IncrementalArgumentsParser
+from .executor import ShellSession, ResourceLimits
 from .conversation import Conversation
+from .outputs import OutputStore
+
+# openai (and its pydantic types) are slow to import, so they are only imported once a request is actually sent
+if TYPE_CHECKING:
+	from openai.types.chat import ChatCompletion
+	from openai.types.chat import ChatCompletionMessageToolCall
+	from .cache import ResponseCache
+	from .recipes import RecipeIndex
+	from .functions import CommandBatch
 
 logger = logging.getLogger("gptdo")
 
+def get_cached_tokens(usage) -> int:
+	"""The number of prompt tokens the API read from its prompt cache, if it reported it"""
+	details = getattr(usage, "prompt_tokens_details", None)
+	return getattr(details, "cached_tokens", None)
+
 class GPTDoChatbot:
-	def __init__(self, gpt_model : str="gpt-4o-mini", auto_approve : bool=False, raw : bool=False, context_files : list=None):
+	def __init__(self, gpt_model : str="gpt-4o-mini", auto_approve : bool=False, raw : bool=False, context_files : list=None, stream : bool=False, token_budget : int=None, persistent_shell : bool=False, cache : 'ResponseCache'=None, bypass_cache : bool=False, api_key : str=None, client : APIClient=None, profile : bool=False, recipes : 'RecipeIndex'=None, command_timeouts : dict=None, resource_limits : ResourceLimits=None):
 		self.gpt_model : str = gpt_model
 		self.auto_approve : bool = auto_approve
-		self.conversation : Conversation = Conversation(context_files=context_files)
+		# Raw prompts may be answered from the cache, in which case generating the full context would be wasted
+		self.conversation : Conversation = Conversation(context_files=context_files, token_budget=token_budget, defer_context=cache is not None)
 		self.inline_prompt = False
 		self.raw_output = raw
+		self.stream : bool = stream
+		# (wall-clock, idle-output) timeouts of each command, by function name
+		self.command_timeouts : 'dict[str, tuple[float, float]]' = command_timeouts or {}
+		# Only auto-approved commands, which no one looked at before they ran, are limited
+		self.resource_limits : ResourceLimits = resource_limits if auto_approve and resource_limits else None
+		self.shell : ShellSession = ShellSession(limits=self.resource_limits) if persistent_shell else None
+		# What the user types is forwarded to commands streaming their output, if it comes from a terminal
+		self.forward_stdin : bool = sys.stdin.isatty()
+		# Set to stop the commands running for the current prompt, from another thread (see CommandBatch._collect)
+		self.cancel_commands = threading.Event()
+		self.cache : 'ResponseCache' = cache
+		self.api_key : str = api_key
+		self.client : APIClient = client or APIClient(api_key=api_key)
+		self.bypass_cache : bool = bypass_cache
+		self.recipes : 'RecipeIndex' = recipes
+		self.turn_metrics : 'list[dict]' = []
+		self.command_metrics : 'list[dict]' = []
+		self.outputs : OutputStore = OutputStore()
+		self.task_metrics : 'list[dict]' = []
+		# (function name, commands, success) of each tool call of the current task
+		self._task_commands : 'list[tuple[str, list[str], bool]]' = []
+		self.tracer = tracing.Tracer()
+		self.profile : bool = profile
+		self._first_request_sent = False
+		# Batches of commands dispatched while a response is streamed in, by index of their tool call
+		self._streamed_batches : 'dict[int, CommandBatch]' = {}
 		
 	def start(self, prompt : str=None):
-		from . import history
+		if not self.raw_output:
+			from . import history
 		if prompt:
 			self.inline_prompt = True
 
 		logger.debug(f"Starting chat (inline prompt: {self.inline_prompt})")
 		
-		while True:
-			while not prompt:
-				prompt = input("Prompt >> ")
+		try:
+			while True:
+				while not prompt:
+					prompt = self.input("Prompt >> ")
 
-			self.process_input(prompt)
-			prompt = None
+				try:
+					self.process_input(prompt)
+				except gptdo_exc.RequestFailed as e:
+					logger.error(f"{e.__class__.__name__}: {e}")
+					self.write(f"ERR: {e}\n", "stderr")
+					if self.raw_output:
+						sys.exit(1)
 
-			if self.inline_prompt:
-				prompt = input("Prompt (Enter to exit) >> ")
+				prompt = None
 
-				util.clear_and_return_to_previous_line()
+				if self.inline_prompt:
+					prompt = self.input("Prompt (Enter to exit) >> ")
 
-				if not prompt:
-					exit(0)
-				else:
-					print(f"Prompt >> {prompt}")
-				
+					self.clear_and_return_to_previous_line()
+
+					if not prompt:
+						sys.exit(0)
+					else:
+						self.write(f"Prompt >> {prompt}\n")
+		finally:
+			if self.profile:
+				self.write("\n" + self.tracer.report() + "\n" + self.outputs.summary(), "stderr")
 
-				
 
 	def process_input(self, prompt : str):
-		# Add prompt to conversation
-		self.conversation.add_user_message(prompt)
-		if not self.inline_prompt:
-			util.clear_and_return_to_previous_line()
-			self.print(util.format_message(self.conversation.last) + "\n\n")
-		else:
-			logger.info("User >> " + prompt)
+		self.cancel_commands.clear()
+		with self.tracer.trace_turn():
+			# Add prompt to conversation
+			self.conversation.add_user_message(prompt)
+			if not self.inline_prompt:
+				with tracing.span("render"):
+					self.clear_and_return_to_previous_line()
+					self.print(util.format_message(self.conversation.last) + "\n\n")
+			else:
+				logger.info("User >> " + prompt)
 
-		while self.conversation.next_turn == "assistant":
-			# Generate next message
-			completion = self.generate_completion()
-			self.process_completion(completion)
+			# Round trips to the API (and tool calls made) until the task is done, which parallel tool calls keep down
+			task = { "round_trips": 0, "tool_calls": 0 }
+			self.task_metrics.append(task)
+			self._task_commands = []
 
-			if self.conversation.last.get("role") == "function":
-				logger.info(util.format_message(self.conversation.last) + "\n\n")
+			# Follow-up prompts depend on the rest of the conversation, so only first prompts are matched to recipes
+			first_prompt = sum(m["role"] == "user" for m in self.conversation.messages) == 1
+			recipe = None
+			if first_prompt and self.recipes is not None:
+				recipe = self._offer_recipe(prompt)
 
-	def generate_completion(self):
+			while self.conversation.next_turn == "assistant":
+				# Generate next message
+				with tracing.span("completion", model=self.gpt_model, stream=self.stream) as span:
+					completion = self.generate_completion()
+					usage = getattr(completion, "usage", None)
+					tool_calls = completion.choices[0].message.tool_calls or []
+					span.attributes.update(
+						prompt_tokens=usage.prompt_tokens if usage else None,
+						completion_tokens=usage.completion_tokens if usage else None,
+						cached_tokens=get_cached_tokens(usage),
+						tool_calls=len(tool_calls)
+					)
+
+				task["round_trips"] += 1
+				task["tool_calls"] += len(tool_calls)
+				tracing.annotate(**task)
+
+				self.process_completion(completion)
+
+				if self.conversation.last.get("role") == "tool":
+					logger.info(util.format_message(self.conversation.last) + "\n\n")
+
+			logger.info(f"Task done in {task['round_trips']} round trips, with {task['tool_calls']} tool calls")
+
+			if first_prompt and self.recipes is not None:
+				# A recipe which was used again is recorded under its own prompt, rather than as a new one
+				self._record_recipe(recipe["prompt"] if recipe else prompt)
+
+	def on_commands_run(self, function_name : str, commands : 'list[str]', success : bool):
+		"""Called with the commands of each tool call, once they have all been run (with none for the other functions)"""
+		self._task_commands.append((function_name, commands, success))
+
+	def _offer_recipe(self, prompt : str) -> dict:
+		"""Offers to run the commands of a saved recipe similar to the prompt, instead of asking the model
+
+		If they all succeed the task is done without any request, and the recipe is returned. Otherwise the recipe is
+		forgotten (unless its commands were cancelled), and the model is asked with the failed commands' output.
+		"""
+		from . import functions, recipes, environment
+		with tracing.span("recipe.match") as span:
+			recipe = self.recipes.match(prompt)
+			span.attributes.update(matched=recipe is not None)
+
+		if recipe is None:
+			return None
+
+		logger.info(f"Matched recipe {recipe['key'][:12]} ({recipe['similarity']:.2f}): {recipe['prompt']!r}")
+		self.print(f"Saved recipe for \"{recipe['prompt']}\" ({recipe['similarity']:.0%} match, used {recipe['uses']} times):")
+		self.print("\n".join(f" > {command}" for command in recipe["commands"]) + "\n")
+
+		# Auto-approve only skips the question for the exact same prompt, in the directory it was recorded in
+		same_task = recipes.normalize(recipe["prompt"]) == recipes.normalize(prompt) and recipe["cwd"] == environment.getcwd()
+		if not (self.auto_approve and same_task):
+			choice = self.input("Run these commands instead of asking? (Y/n) ")
+			self.clear_and_return_to_previous_line()
+			if choice.lower() not in ["", "y"]:
+				return None
+
+		call = SimpleNamespace(id="recipe_" + recipe["key"][:12], function=SimpleNamespace(
+			name=functions.FUNC_RUN_COMMANDS["name"],
+			arguments=json.dumps({ "stream_stdout_to_user": True, "commands": recipe["commands"] })
+		))
+		self.conversation.add_assistant_message(None, tool_calls=[
+			{ "id": call.id, "type": "function", "function": { "name": call.function.name, "arguments": call.function.arguments } }
+		])
+
+		batch = functions.CommandBatch(self, stream_stdout_to_user=True, function_name=call.function.name, approved=True)
+		succeeded = functions.process_tool_calls(self, [(call, json.loads(call.function.arguments))], batches={ 0: batch })
+		if batch.cancelled:
+			# The recipe wasn't at fault, so it is kept, and the model is asked with what was run before the interrupt
+			return None
+
+		if succeeded:
+			self.conversation.add_assistant_message(f"Ran the saved commands for \"{recipe['prompt']}\".")
+			return recipe
+
+		logger.info(f"Recipe {recipe['key'][:12]} failed, forgetting it")
+		self.recipes.forget(recipe["key"])
+		self.print("The saved commands failed, asking for new ones.\n")
+		return None
+
+	def _record_recipe(self, prompt : str):
+		"""Saves the commands of a task as a recipe, if they all succeeded
+
+		Tasks which gathered context first (with commands or any other function) are left out, since their commands may
+		depend on what was found (e.g. a PID), and so are those with cancelled commands, which may not have done it all.
+		"""
 		from . import functions
-		completion : ChatCompletion = openai.chat.completions.create(
+		run = [(commands, success) for function_name, commands, success in self._task_commands if function_name == functions.FUNC_RUN_COMMANDS["name"]]
+		if not run or len(run) != len(self._task_commands) or not all(success for _, success in run):
+			return
+
+		commands = [command for batch_commands, _ in run for command in batch_commands]
+		with tracing.span("recipe.record", commands=len(commands)):
+			self.recipes.record(prompt, commands)
+
+	def generate_completion(self):
+		from . import functions, START_TIME
+		if not self._first_request_sent:
+			self._first_request_sent = True
+			logger.debug(f"Cold start to first request: {(time.perf_counter() - START_TIME) * 1000:.1f}ms")
+
+		cache_key = None
+		if self.cache is not None:
+			cache_key = self.cache.key(self.gpt_model, self.conversation.messages, self.conversation.get_stable_context())
+			cached = None if self.bypass_cache else self.cache.get(cache_key)
+			if cached is not None:
+				logger.info(f"Using cached completion {cache_key[:12]}")
+				tracing.annotate(cached=True)
+				# Attribute access is all that's needed to process a completion, so the openai types aren't imported for cache hits
+				return json.loads(cached, object_hook=lambda fields: SimpleNamespace(**fields))
+
+		request = dict(
 			model=self.gpt_model,
-			messages=self.conversation.messages,
-			function_call="auto",
-			functions=[
-				functions.FUNC_RUN_COMMANDS,
-				functions.FUNC_RUN_COMMANDS_FOR_CONTEXT
-			]
+			messages=self.conversation.window(),
+			tool_choice="auto",
+			tools=functions.TOOLS,
+			parallel_tool_calls=True
 		)
 
+		if self.stream:
+			completion = self._generate_streamed_completion(request)
+		else:
+			start = time.perf_counter()
+			stats = {}
+			completion : 'ChatCompletion' = self.client.create(request, stats)
+			self._record_turn_metrics(start, None, time.perf_counter(), completion.usage.completion_tokens if completion.usage else None, stats, completion.usage)
+
+		# Only recommended commands are worth caching, since raw mode fails on anything else
+		if cache_key is not None and completion.choices[0].message.tool_calls:
+			self.cache.put(cache_key, completion.model_dump_json())
+
 		return completion
+
+	def _generate_streamed_completion(self, request : dict) -> 'ChatCompletion':
+		"""Renders the response as it arrives, and assembles the streamed deltas into a regular completion"""
+		from openai.types.chat import ChatCompletion, ChatCompletionMessage
+		from openai.types.chat.chat_completion import Choice
+		from openai.types.chat import ChatCompletionMessageToolCall
+		from openai.types.chat.chat_completion_message_tool_call import Function
+		start = time.perf_counter()
+		first_token = None
+		chunks = 0
+		usage = None
+		finish_reason = None
+		content = ""
+		# Tool calls are streamed in by index, and may be interleaved
+		tool_calls : 'dict[int, dict]' = {}
+		parsers : 'dict[int, IncrementalArgumentsParser]' = {}
+		formatter = None
+		self._streamed_batches = {}
+		stats = {}
+
+		# The id, creation time and model of the completion are taken from its last chunk
+		chunk = None
+		stream = self.client.stream({ **request, "stream_options": {"include_usage": True} }, stats)
+		for chunk in stream:
+			if chunk.usage:
+				usage = chunk.usage
+
+			if not chunk.choices:
+				continue
+
+			choice = chunk.choices[0]
+			delta = choice.delta
+			finish_reason = choice.finish_reason or finish_reason
+
+			if first_token is None and (delta.content or delta.tool_calls):
+				first_token = time.perf_counter()
+
+			if delta.content:
+				chunks += 1
+				content += delta.content
+
+				if self.inline_prompt:
+					self._print_stream(delta.content)
+				else:
+					if formatter is None:
+						formatter = util.StreamFormatter("assistant")
+						self._print_stream(formatter.start())
+					self._print_stream(formatter.feed(delta.content))
+
+			for tool_call in delta.tool_calls or []:
+				chunks += 1
+				call = tool_calls.setdefault(tool_call.index, { "id": "", "name": "", "arguments": "" })
+				call["id"] = tool_call.id or call["id"]
+				if tool_call.function is None:
+					continue
+
+				call["name"] += tool_call.function.name or ""
+				call["arguments"] += tool_call.function.arguments or ""
+
+				if tool_call.index not in parsers and self._can_dispatch_early(call["name"]):
+					parsers[tool_call.index] = IncrementalArgumentsParser("commands")
+
+				parser = parsers.get(tool_call.index)
+				if parser is not None and tool_call.function.arguments:
+					self._dispatch_streamed_commands(tool_call.index, call["name"], parser, parser.feed(tool_call.function.arguments))
+
+		if chunk is None:
+			# e.g. a proxy closing the connection before the response started
+			raise gptdo_exc.RequestFailed("The streamed response ended before any of it was received")
+
+		if content:
+			self._print_stream((formatter.finish() + "\n\n") if formatter else "\n")
+			logger.info("TO USER (streamed):\n" + content)
+
+		end = time.perf_counter()
+		self._record_turn_metrics(start, first_token, end, usage.completion_tokens if usage else chunks, stats, usage)
+
+		message = ChatCompletionMessage(
+			role="assistant",
+			content=content or None,
+			tool_calls=[
+				ChatCompletionMessageToolCall(id=call["id"], type="function", function=Function(name=call["name"], arguments=call["arguments"]))
+				for _, call in sorted(tool_calls.items())
+			] or None
+		)
+
+		return ChatCompletion(
+			id=chunk.id,
+			choices=[Choice(finish_reason=finish_reason or "stop", index=0, message=message)],
+			created=chunk.created,
+			model=chunk.model,
+			object="chat.completion",
+			usage=usage
+		)
+
+	def _can_dispatch_early(self, function_name : str) -> bool:
+		from . import functions
+		if self.raw_output:
+			return False
+
+		return function_name in functions.RUN_COMMAND_FUNCTIONS
+
+	def _dispatch_streamed_commands(self, index : int, function_name : str, parser : IncrementalArgumentsParser, commands : list):
+		"""Runs (or asks for approval of) each command as soon as it has been streamed in, while the rest are still being generated"""
+		from . import functions
+		for command in commands:
+			# Like the rest of the commands of a call, later calls aren't run once a command has stopped its call
+			if index not in self._streamed_batches and self._stopped_streamed_batch(index) is not None:
+				return
+
+			if index not in self._streamed_batches:
+				self._streamed_batches[index] = functions.create_batch(self, function_name, stream_stdout_to_user=parser.values.get("stream_stdout_to_user", False))
+				logger.info(f"Dispatching the commands of tool call {index} as they are streamed in")
+
+			logger.info(f"Recommended command: {command}")
+			self._streamed_batches[index].run(command)
+
+	def _stopped_streamed_batch(self, index : int) -> 'CommandBatch':
+		"""The batch of an earlier call of the response being streamed which stopped before running all its commands"""
+		return next((batch for i, batch in sorted(self._streamed_batches.items()) if i < index and batch.stopped and not batch.concurrent), None)
+
+	def _record_turn_metrics(self, start : float, first_token : float, end : float, completion_tokens : int, stats : dict=None, usage=None):
+		stats = stats or {}
+		metrics = {
+			"turn": len(self.turn_metrics) + 1,
+			"latency": end - start,
+			"time_to_first_token": (first_token - start) if first_token else None,
+			"completion_tokens": completion_tokens,
+			"tokens_per_second": None,
+			"retries": stats.get("retries", 0),
+			"backoff_time": stats.get("backoff_time", 0.0),
+			"prompt_tokens": usage.prompt_tokens if usage else None,
+			"cached_tokens": get_cached_tokens(usage),
+		}
+
+		generation_time = end - (first_token or start)
+		if completion_tokens and generation_time > 0:
+			metrics["tokens_per_second"] = completion_tokens / generation_time
+
+		self.turn_metrics.append(metrics)
+		tracing.annotate(time_to_first_token=metrics["time_to_first_token"], retries=metrics["retries"], backoff_time=metrics["backoff_time"])
+
+		ttft = f"{metrics['time_to_first_token'] * 1000:.0f}ms" if first_token else "n/a"
+		tps = f"{metrics['tokens_per_second']:.1f}" if metrics["tokens_per_second"] else "n/a"
+		retries = f", {metrics['retries']} retries ({metrics['backoff_time'] * 1000:.0f}ms backing off)" if metrics["retries"] else ""
+		logger.info(f"Turn {metrics['turn']}: latency {metrics['latency'] * 1000:.0f}ms, time to first token {ttft}, {completion_tokens} completion tokens ({tps} tokens/s){retries}")
+
+		if metrics["prompt_tokens"]:
+			# The hit rate of the API's prompt cache, which only applies to the unchanged start of the prompt
+			prompt_tokens = sum(m["prompt_tokens"] or 0 for m in self.turn_metrics)
+			cached_tokens = sum(m["cached_tokens"] or 0 for m in self.turn_metrics)
+			logger.info(f"Turn {metrics['turn']}: {metrics['cached_tokens'] or 0}/{metrics['prompt_tokens']} prompt tokens cached, {cached_tokens / prompt_tokens:.0%} over the session")
+
+	def write(self, text : str, stream : str="stdout"):
+		"""Writes to the user's terminal. All terminal I/O goes through `write` and `input`, which the daemon overrides"""
+		file = sys.stderr if stream == "stderr" else sys.stdout
+		file.write(text)
+		file.flush()
+
+	def input(self, prompt : str) -> str:
+		return input(prompt)
+
+	def clear_and_return_to_previous_line(self):
+		self.write(util.clear_previous_line_sequence())
+
+	def _print_stream(self, content : str):
+		if self.raw_output or not content:
+			return
+
+		self.write(content)
 	
-	def print(self, *content : str, **kwargs):
+	def print(self, *content : str, end : str="\n", **kwargs):
 		content : str = " ".join(content)
 		logger.info("TO USER:\n" + content)
 
 		if self.raw_output:
 			return
 
-		print(content, **kwargs)
+		self.write(content + end)
 
-	def process_completion(self, completion : ChatCompletion):
+	def process_completion(self, completion : 'ChatCompletion'):
 		response = completion.choices[0].message
-		function_call = response.function_call
+		tool_calls = response.tool_calls or []
 
-		if self.raw_output and not function_call:
-			print(response.content, file=sys.stderr)
-			print("ERR: No commands were recommended.", file=sys.stderr)
-			exit(1)
+		if self.raw_output and not tool_calls:
+			self.write(f"{response.content}\n", "stderr")
+			self.write("ERR: No commands were recommended.\n", "stderr")
+			sys.exit(1)
 
-		if response.content:
-			self.conversation.add_assistant_message(response.content)
+		if response.content or tool_calls:
+			self.conversation.add_assistant_message(response.content, tool_calls=[
+				{ "id": call.id, "type": "function", "function": { "name": call.function.name, "arguments": call.function.arguments } }
+				for call in tool_calls
+			])
 
-			if not function_call:
-				content = response.content if self.inline_prompt else util.format_message(self.conversation.last) + "\n\n"
-				self.print(content)
+			if response.content and not tool_calls and not self.stream:
+				with tracing.span("render"):
+					content = response.content if self.inline_prompt else util.format_message(self.conversation.last) + "\n\n"
+					self.print(content)
 
-		if function_call:
-			success = self.process_function_call(function_call)
+		if tool_calls:
+			success = self.process_tool_calls(tool_calls)
 			if not success:
 				self.inline_prompt = False
-		
-	def process_function_call(self, function_call : FunctionCall):
+
+	def process_tool_calls(self, tool_calls : 'list[ChatCompletionMessageToolCall]') -> bool:
 		from . import functions
-		name = function_call.name
-		arguments = json.loads(function_call.arguments)
-
-		if name in [functions.FUNC_RUN_COMMANDS["name"], functions.FUNC_RUN_COMMANDS_FOR_CONTEXT["name"]]:
-			commands = arguments["commands"]
-			if self.raw_output:
-				logger.info("Recommending commands as raw output: \n" + "\n".join(commands))
-				for command in commands:
-					print(command)
-
-				exit(0)
-			
-			return functions.process_func_run_commands(self, commands, stream_stdout_to_user=arguments.get("stream_stdout_to_user", False))
+		calls = []
+		for call in tool_calls:
+			with tracing.span("function_call.parse", function=call.function.name, size=len(call.function.arguments)):
+				calls.append((call, json.loads(call.function.arguments)))
+
+		commands = [command for call, arguments in calls if call.function.name in functions.RUN_COMMAND_FUNCTIONS for command in arguments["commands"]]
+		if self.raw_output and commands:
+			logger.info("Recommending commands as raw output: \n" + "\n".join(commands))
+			for command in commands:
+				self.write(command + "\n")
+
+			sys.exit(0)
+
+		batches, self._streamed_batches = self._streamed_batches, {}
+		return functions.process_tool_calls(self, calls, batches=batches)
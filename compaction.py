@@ -0,0 +1,185 @@
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger("gptdo")
+
+# Rough per-message overhead of the chat format (role, separators...)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+	"""tiktoken is optional, and only imported the first time tokens are counted"""
+	global _encoding, _encoding_loaded
+	if not _encoding_loaded:
+		_encoding_loaded = True
+		try:
+			import tiktoken
+			_encoding = tiktoken.get_encoding("o200k_base")
+		except Exception:
+			_encoding = None
+
+	return _encoding
+
+@lru_cache(maxsize=1024)
+def count_tokens(text : str) -> int:
+	"""Counts tokens with tiktoken if it's installed, otherwise estimates ~4 characters per token"""
+	if not text:
+		return 0
+
+	encoding = _get_encoding()
+	if encoding is not None:
+		return len(encoding.encode(text, disallowed_special=()))
+
+	return len(text) // 4 + 1
+
+def count_message_tokens(message : dict) -> int:
+	tool_calls = sum(count_tokens(call["function"]["name"]) + count_tokens(call["function"]["arguments"]) for call in message.get("tool_calls") or [])
+	return MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "") + count_tokens(message.get("name") or "") + tool_calls
+
+def count_messages_tokens(messages : 'list[dict]') -> int:
+	return sum(count_message_tokens(m) for m in messages)
+
+
+class CompactionStrategy:
+	"""Shrinks a conversation window which is over its token budget
+
+	`apply` receives a copy of the messages (system prompt first, latest message last) and returns the compacted
+	messages. Strategies are applied in order, until the window fits the budget.
+	"""
+	def apply(self, messages : 'list[dict]', budget : int) -> 'list[dict]':
+		raise NotImplementedError()
+
+	def __repr__(self):
+		return self.__class__.__name__
+
+
+class ElideOldFunctionOutputs(CompactionStrategy):
+	"""Replaces the output of all but the latest `keep_last` tool (or function) calls with just their list of commands run"""
+	def __init__(self, keep_last : int=2):
+		self.keep_last = keep_last
+
+	def apply(self, messages, budget):
+		function_indices = [i for i, m in enumerate(messages) if m["role"] in ["tool", "function"]]
+		for i in function_indices[:max(len(function_indices) - self.keep_last, 0)]:
+			content = messages[i]["content"]
+			summary = content.strip().split("\n\n")[0]
+			messages[i] = { **messages[i], "content": f"{summary}\n\n[Output of this earlier function call was elided to save space]" }
+
+		return messages
+
+
+class TruncateLargeMessages(CompactionStrategy):
+	"""Keeps only the head and tail of any message (other than the system prompt and the latest prompt) over `max_tokens`
+
+	The latest tool results are truncated too, as a single large command output is the usual reason to be over budget.
+	"""
+	def __init__(self, max_tokens : int=1000):
+		self.max_tokens = max_tokens
+
+	def apply(self, messages, budget):
+		end = len(messages) if messages[-1]["role"] in ["tool", "function"] else len(messages) - 1
+		for i in range(1, end):
+			content = messages[i].get("content") or ""
+			tokens = count_tokens(content)
+			if tokens <= self.max_tokens:
+				continue
+
+			# Keep the same proportion of characters as the proportion of tokens allowed, split between head and tail
+			keep = max(int(len(content) * self.max_tokens / tokens) // 2, 1)
+			elided = len(content) - keep * 2
+			messages[i] = {
+				**messages[i],
+				"content": f"{content[:keep]}\n\n[... {elided} characters elided ...]\n\n{content[-keep:]}"
+			}
+
+		return messages
+
+
+class SummarizeOldTurns(CompactionStrategy):
+	"""Folds everything but the system prompt and the latest `keep_last` messages into a single summary message"""
+	def __init__(self, keep_last : int=6, max_chars_per_message : int=200):
+		self.keep_last = keep_last
+		self.max_chars_per_message = max_chars_per_message
+
+	def apply(self, messages, budget):
+		start = max(len(messages) - self.keep_last, 1)
+		# Tool results must stay right after the message with their calls
+		while start > 1 and messages[start]["role"] == "tool":
+			start -= 1
+
+		old = messages[1:start]
+		if not old:
+			return messages
+
+		summary = "Summary of the earlier part of this conversation:"
+		for message in old:
+			content = " ".join((message.get("content") or "").split())
+			if message.get("tool_calls"):
+				content = (content + " " if content else "") + " ".join(f"Called `{call['function']['name']}` with {call['function']['arguments']}" for call in message["tool_calls"])
+			if len(content) > self.max_chars_per_message:
+				content = content[:self.max_chars_per_message] + "..."
+
+			name = f"Function `{message['name']}`" if message["role"] == "function" else message["role"].capitalize()
+			summary += f"\n - {name}: {content}"
+
+		return [messages[0], { "role": "system", "content": summary }] + messages[len(old) + 1:]
+
+
+class DropOldestMessages(CompactionStrategy):
+	"""Last resort: drops the oldest turns after the system prompt until the window fits
+
+	A message with tool calls is dropped together with their results, which would be rejected without it. If the latest
+	turn alone still doesn't fit, its messages are truncated to share what is left of the budget.
+	"""
+	def apply(self, messages, budget):
+		while count_messages_tokens(messages) > budget:
+			end = 2
+			while end < len(messages) and messages[end]["role"] in ["tool", "function"]:
+				end += 1
+
+			if end >= len(messages):
+				break
+
+			del messages[1:end]
+
+		if count_messages_tokens(messages) > budget and len(messages) > 1:
+			available = budget - count_message_tokens(messages[0]) - MESSAGE_OVERHEAD_TOKENS * (len(messages) - 1)
+			max_tokens = max(available // (len(messages) - 1), 1)
+			messages = TruncateLargeMessages(max_tokens=max_tokens).apply(messages, budget)
+
+		return messages
+
+
+DEFAULT_STRATEGIES = [
+	ElideOldFunctionOutputs(),
+	TruncateLargeMessages(),
+	SummarizeOldTurns(),
+	DropOldestMessages(),
+]
+
+def compact(messages : 'list[dict]', budget : int, strategies : 'list[CompactionStrategy]'=None) -> 'list[dict]':
+	"""Returns a window of `messages` which fits within `budget` tokens, leaving `messages` itself untouched"""
+	if strategies is None:
+		strategies = DEFAULT_STRATEGIES
+
+	before = count_messages_tokens(messages)
+	if not budget or before <= budget:
+		logger.info(f"Conversation window: {before} tokens (budget {budget or 'unlimited'})")
+		return messages
+
+	window = list(messages)
+	applied = []
+	for strategy in strategies:
+		window = strategy.apply(window, budget)
+		applied.append(repr(strategy))
+		if count_messages_tokens(window) <= budget:
+			break
+
+	after = count_messages_tokens(window)
+	logger.info(f"Conversation window: {before} tokens before compaction, {after} after (budget {budget}, applied {', '.join(applied)})")
+	if after > budget:
+		logger.warning(f"Conversation window is still over its token budget after compaction ({after} > {budget})")
+
+	return window
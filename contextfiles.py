@@ -0,0 +1,180 @@
+import os
+import re
+import mmap
+import math
+import threading
+import logging
+from collections import OrderedDict, Counter
+from . import tracing
+
+logger = logging.getLogger("gptdo")
+
+# Bytes of a context file included in the prompt. Larger files are split into chunks, of which only those most
+# relevant to the conversation are included. Can be changed with GPTDO_CONTEXT_FILE_LIMIT
+DEFAULT_FILE_LIMIT = 16 * 1024
+
+# Target size of the chunks large files are split into, on line boundaries
+CHUNK_BYTES = 2048
+
+# Files at least this large are read through a memory map instead of being read into memory whole
+MMAP_THRESHOLD = 1024 * 1024
+
+# Loaded files kept in memory, least recently used first
+MAX_CACHED_FILES = 16
+
+WORD = re.compile(rb"[A-Za-z_][A-Za-z0-9_]{2,}")
+
+# Words too common in prompts to say anything about which part of a file is relevant
+STOP_WORDS = {
+	b"the", b"and", b"for", b"are", b"but", b"not", b"you", b"all", b"can", b"was", b"this", b"that", b"with", b"have",
+	b"from", b"what", b"why", b"how", b"which", b"when", b"where", b"there", b"does", b"did", b"into", b"out", b"about",
+	b"file", b"files", b"show", b"tell", b"find", b"please", b"use", b"using", b"get", b"make", b"run", b"its", b"it's",
+}
+
+def get_file_limit() -> int:
+	return int(os.getenv("GPTDO_CONTEXT_FILE_LIMIT", DEFAULT_FILE_LIMIT))
+
+def tokenize(data : bytes) -> 'list[bytes]':
+	return [word for word in WORD.findall(data.lower()) if word not in STOP_WORDS]
+
+
+class ContextFile:
+	"""A context file as of its last modification: its whole text if it fits within the limit, or else an index of its chunks
+
+	The text of a large file isn't kept in memory, only the offsets of its chunks and the words in each of them. The
+	chunks are read back from the file when they are included in the prompt.
+	"""
+	def __init__(self, path : str, mtime : int, size : int, limit : int):
+		self.path = path
+		self.mtime = mtime
+		self.size = size
+		self.limit = limit
+		self.text : str = None
+		self.chunks : 'list[tuple[int, int]]' = []
+		self.chunk_lines : 'list[int]' = []
+		# Word -> {chunk: occurrences}
+		self.index : 'dict[bytes, dict[int, int]]' = {}
+
+	@property
+	def oversized(self) -> bool:
+		return self.text is None
+
+	def load(self) -> 'ContextFile':
+		with open(self.path, "rb") as f:
+			if self.size <= self.limit:
+				self.text = f.read().decode("utf-8", errors="replace")
+				return self
+
+			with _map(f, self.size) as data:
+				self._index(data)
+
+		return self
+
+	def _index(self, data):
+		chunk_bytes = min(CHUNK_BYTES, self.limit)
+		start, line = 0, 1
+		while start < self.size:
+			end = min(start + chunk_bytes, self.size)
+			if end < self.size:
+				# Chunks end at a line break, unless a single line is longer than a chunk
+				line_end = data.rfind(b"\n", start, end)
+				end = line_end + 1 if line_end >= start else end
+
+			chunk = data[start:end]
+			for word, count in Counter(tokenize(chunk)).items():
+				self.index.setdefault(word, {})[len(self.chunks)] = count
+
+			self.chunks.append((start, end))
+			self.chunk_lines.append(line)
+			line += chunk.count(b"\n")
+			start = end
+
+	def rank(self, query : 'list[bytes]') -> 'list[int]':
+		"""The chunks matching the query, most relevant first, scored by the frequency of each word weighted by its rarity"""
+		scores : 'dict[int, float]' = {}
+		for word in set(query):
+			postings = self.index.get(word)
+			if not postings:
+				continue
+
+			idf = math.log(1 + len(self.chunks) / len(postings))
+			for chunk, count in postings.items():
+				scores[chunk] = scores.get(chunk, 0.0) + idf * count / (count + 1.2)
+
+		return sorted(scores, key=lambda chunk: (-scores[chunk], chunk))
+
+	def excerpts(self, query : 'list[bytes]') -> str:
+		"""The chunks most relevant to the query which fit within the limit, in the order they appear in the file
+
+		Without any matching chunk, the start and the end of the file are included.
+		"""
+		ranked = self.rank(query)
+		if not ranked:
+			ranked = [0, len(self.chunks) - 1]
+
+		selected, total = [], 0
+		for chunk in ranked:
+			start, end = self.chunks[chunk]
+			if chunk in selected or total + end - start > self.limit:
+				continue
+
+			selected.append(chunk)
+			total += end - start
+
+		output = ""
+		with open(self.path, "rb") as f, _map(f, self.size) as data:
+			for chunk in sorted(selected):
+				start, end = self.chunks[chunk]
+				first_line = self.chunk_lines[chunk]
+				last_line = max(first_line, self.chunk_lines[chunk + 1] - 1) if chunk + 1 < len(self.chunks) else "end"
+				output += f"\n[... lines {first_line}-{last_line} ...]\n" + data[start:end].decode("utf-8", errors="replace")
+
+		return output
+
+
+class _map:
+	"""Memory maps large files, and reads smaller ones into memory. Either way the data is sliced the same"""
+	def __init__(self, f, size : int):
+		self.f = f
+		self.size = size
+		self.data = None
+
+	def __enter__(self):
+		if self.size >= MMAP_THRESHOLD:
+			self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			self.f.seek(0)
+			self.data = self.f.read()
+		return self.data
+
+	def __exit__(self, *args):
+		if isinstance(self.data, mmap.mmap):
+			self.data.close()
+
+
+_cache : 'OrderedDict[str, ContextFile]' = OrderedDict()
+_cache_lock = threading.Lock()
+
+def load(path : str) -> ContextFile:
+	"""The context file at `path`, which is only read again once its modification time or size change"""
+	stat = os.stat(path)
+	limit = get_file_limit()
+	with _cache_lock:
+		cached = _cache.get(path)
+		if cached is not None and (cached.mtime, cached.size, cached.limit) == (stat.st_mtime_ns, stat.st_size, limit):
+			_cache.move_to_end(path)
+			return cached
+
+	with tracing.span("context_file.load", path=path, size=stat.st_size):
+		context_file = ContextFile(path, stat.st_mtime_ns, stat.st_size, limit).load()
+
+	if context_file.oversized:
+		logger.debug(f"Context file {path} is {stat.st_size} bytes, over the {limit} bytes limit: indexed {len(context_file.chunks)} chunks")
+
+	with _cache_lock:
+		_cache[path] = context_file
+		_cache.move_to_end(path)
+		while len(_cache) > MAX_CACHED_FILES:
+			_cache.popitem(last=False)
+
+	return context_file
@@ -1,13 +1,31 @@
 import os
-from .context import generate_system_prompt, CONTEXT_DIR
+from .context import generate_system_prompt, generate_volatile_context, get_stable_context, CONTEXT_DIR
+from typing import TYPE_CHECKING
+from . import capture, compaction, contextfiles, environment, tracing
+
+if TYPE_CHECKING:
+	from .sessions import SessionLog
+
+# Latest messages, on top of every user message, whose words select the excerpts of large context files
+EXCERPT_QUERY_MESSAGES = 2
 
 class Conversation:
-	def __init__(self, context_files : list=None):
+	def __init__(self, context_files : list=None, token_budget : int=None, compaction_strategies : 'list[compaction.CompactionStrategy]'=None, defer_context : bool=False):
 		self.messages = []
 		self.next_turn = "user"
 		self.context_files = context_files
+		self.token_budget = token_budget
+		self.compaction_strategies = compaction_strategies
+		# Set to persist the messages as they are added, see sessions.py
+		self.session : 'SessionLog' = None
+		self._context_deferred = False
 
-		self.initialize_context()
+		if defer_context:
+			# The system prompt is only generated once it is first needed, see window()
+			self.messages = [{ "role": "system", "content": "" }]
+			self._context_deferred = True
+		else:
+			self.initialize_context()
 
 	def initialize_context(self, extra_context : str=None):
 		context_msg = {
@@ -27,44 +45,137 @@ class Conversation:
 		else:
 			self.messages[0] = context_msg
 
-	def _get_extra_context(self):
-		extra_context = "\n\n# SPECIFIC CONTEXT FOR THIS CONVERSATION:"
-		for context_file in self.context_files:
+		self._context_deferred = False
+
+	def get_stable_context(self) -> str:
+		"""The parts of the context which identify the environment a prompt was asked in, for caching responses"""
+		stable_context = get_stable_context()
+		if self.context_files is not None:
+			stable_context += self._get_extra_context()
+			# Only the excerpts of large files are in the prompt, and they depend on the messages, which are part of the key
+			stable_context += "".join(f"\n{f.path}:{f.mtime}" for f in self._load_context_files() if f.oversized)
+
+		return stable_context
+
+	def _load_context_files(self) -> 'list[contextfiles.ContextFile]':
+		loaded = []
+		for name in self.context_files:
+			# Relative paths are relative to where gptdo was run, which isn't the daemon's working directory
+			context_file = os.path.join(environment.getcwd(), name)
 			if not os.path.exists(context_file):
-				context_file = os.path.join(CONTEXT_DIR, context_file)
+				context_file = os.path.join(CONTEXT_DIR, name)
 
 			if not os.path.exists(context_file):
-				raise Exception(f"Context file {os.path.basename(context_file)} or {context_file} does not exist")
-			
-			with open(context_file, "r") as f:
-				extra_context += f"\n\n## Context File: {context_file}"
-				extra_context += "\n" + f.read()
+				raise Exception(f"Context file {name} or {context_file} does not exist")
+
+			loaded.append(contextfiles.load(context_file))
+
+		return loaded
+
+	def _get_extra_context(self):
+		extra_context = "\n\n# SPECIFIC CONTEXT FOR THIS CONVERSATION:"
+		for context_file in self._load_context_files():
+			extra_context += f"\n\n## Context File: {context_file.path}"
+			if context_file.oversized:
+				extra_context += f"\n({context_file.size} bytes, too large to include whole: the parts most relevant to the conversation are in the CURRENT ENVIRONMENT message)"
+			else:
+				extra_context += "\n" + context_file.text
 
 		return extra_context
 
+	def _get_context_file_excerpts(self) -> str:
+		"""The chunks of each large context file which best match the conversation so far"""
+		oversized = [f for f in self._load_context_files() if f.oversized] if self.context_files else []
+		if not oversized:
+			return ""
+
+		recent = self.messages[1:][-EXCERPT_QUERY_MESSAGES:]
+		query_messages = [m for m in self.messages if m["role"] == "user" and m not in recent] + recent
+		query = contextfiles.tokenize("\n".join(m.get("content") or "" for m in query_messages).encode("utf-8"))
+
+		excerpts = ""
+		with tracing.span("context_file.excerpts", files=len(oversized)):
+			for context_file in oversized:
+				excerpts += f"\n\n## Excerpts of Context File: {context_file.path}\n" + context_file.excerpts(query)
+
+		return excerpts
+
+
+	def window(self) -> 'list[dict]':
+		"""The messages to send for the next completion, compacted to fit within the token budget
+
+		The system prompt and the conversation so far only ever grow at the end, so each request starts with the
+		previous one, which the API can cache. The current state of the environment is sent after them, as a
+		separate message which is regenerated for every request and never kept in the conversation.
+		"""
+		if self._context_deferred:
+			self.initialize_context()
+
+		environment_msg = {
+			"role": "system",
+			"content": generate_volatile_context() + self._get_context_file_excerpts()
+		}
+
+		budget = self.token_budget
+		if budget:
+			budget = max(budget - compaction.count_message_tokens(environment_msg), 1)
+
+		with tracing.span("compaction", messages=len(self.messages)):
+			return compaction.compact(self.messages, budget, self.compaction_strategies) + [environment_msg]
+
+	def restore(self, messages : 'list[dict]'):
+		"""Continues a conversation from its messages (without the system prompt, which is generated for this one)"""
+		self.messages = self.messages[:1] + [m for m in messages if m["role"] != "system"]
+		capture.reserve_ids("\n".join(m.get("content") or "" for m in self.messages))
+		self.next_turn = "user"
+
+	def _append(self, message : dict):
+		self.messages.append(message)
+		if self.session is not None:
+			self.session.append(message)
 
 	def add_user_message(self, message):
-		self.messages.append({
+		self._answer_pending_tool_calls()
+		self._append({
 			"role": "user",
 			"content": message
 		})
 		self.next_turn = "assistant"
 
-	def add_function_call(self, fname, content):
-		self.messages.append({
-			"role": "function",
-			"name": fname,
+	def add_tool_result(self, tool_call_id : str, content : str):
+		self._append({
+			"role": "tool",
+			"tool_call_id": tool_call_id,
 			"content": content
 		})
 		self.next_turn = "assistant"
 
-	def add_assistant_message(self, message):
-		self.messages.append({
+	def add_assistant_message(self, message, tool_calls : 'list[dict]'=None):
+		assistant_msg = {
 			"role": "assistant",
 			"content": message
-		})
+		}
+		if tool_calls:
+			# Followed by a tool message with the result of each call
+			assistant_msg["tool_calls"] = tool_calls
+
+		self._append(assistant_msg)
 		self.next_turn = "user"
 
+	def _answer_pending_tool_calls(self):
+		"""Every tool call must have a result, so calls left without one (e.g. interrupted by the user) are marked as such"""
+		answered = set()
+		for message in reversed(self.messages):
+			if message["role"] == "tool":
+				answered.add(message["tool_call_id"])
+			elif message["role"] == "assistant":
+				for call in message.get("tool_calls") or []:
+					if call["id"] not in answered:
+						self.add_tool_result(call["id"], "Interrupted by the user before it could be run.")
+				return
+			else:
+				return
+
 	@property
 	def last(self):
 		return self.messages[-1]
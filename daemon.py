@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+from shutil import get_terminal_size
+from . import ROOT, environment
+
+logger = logging.getLogger("gptdo")
+
+SOCKET_PATH = os.path.join(ROOT, "daemon.sock")
+
+# Seconds without any session after which the daemon shuts down
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+# How often the daemon wakes up to check whether it is idle or has been asked to stop
+POLL_INTERVAL = 1
+
+class Connection:
+	"""Newline-delimited JSON messages over a Unix socket
+
+	The client starts a session with a `start` message, carrying its options, working directory, environment variables
+	and terminal size. The daemon then sends `output` messages to be written to the terminal, `input` messages which the
+	client answers with an `input` (or `eof`) message, and finally an `exit` message with the exit code. The client
+	sends an `interrupt` message when the user presses Ctrl-C, which stops the commands running for the current prompt.
+	"""
+	def __init__(self, sock : socket.socket):
+		self.sock = sock
+		self._reader = sock.makefile("rb")
+		self._lock = threading.Lock()
+
+	def send(self, type : str, **fields):
+		data = (json.dumps({ "type": type, **fields }) + "\n").encode("utf-8")
+		with self._lock:
+			self.sock.sendall(data)
+
+	def receive(self) -> dict:
+		"""Returns the next message, or None once the other end has closed the connection"""
+		line = self._reader.readline()
+		if not line:
+			return None
+
+		return json.loads(line)
+
+	def close(self):
+		# Wakes up a thread blocked in `receive`, which would otherwise hold the reader open
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+		self._reader.close()
+		self.sock.close()
+
+
+class Daemon:
+	"""Serves gptdo sessions to thin clients over a Unix socket, one thread per session
+
+	The API client, the cached context providers and the response cache stay warm between sessions. Each session has
+	its own chatbot, running with the working directory, environment variables and terminal size of its client.
+	"""
+	def __init__(self, config : dict, idle_timeout : float=DEFAULT_IDLE_TIMEOUT, path : str=SOCKET_PATH):
+		self.config = config
+		self.idle_timeout = idle_timeout
+		self.path = path
+		self.sessions = 0
+		self.sessions_served = 0
+		self._last_activity = time.monotonic()
+		self._lock = threading.Lock()
+		self._stopping = False
+
+	def serve(self):
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# Sessions carry the user's environment (and API key), so only the user may connect
+		umask = os.umask(0o177)
+		try:
+			server.bind(self.path)
+		finally:
+			os.umask(umask)
+
+		server.listen()
+		server.settimeout(POLL_INTERVAL)
+		logger.info(f"Daemon listening on {self.path} (pid {os.getpid()}, idle timeout {self.idle_timeout}s)")
+
+		try:
+			while not self._stopping:
+				try:
+					sock, _ = server.accept()
+				except socket.timeout:
+					if self._idle():
+						logger.info(f"Daemon idle for {self.idle_timeout}s, shutting down")
+						break
+					continue
+
+				sock.settimeout(None)
+				threading.Thread(target=self._handle, args=(Connection(sock),), name="gptdo-session", daemon=True).start()
+		finally:
+			server.close()
+			if os.path.exists(self.path):
+				os.unlink(self.path)
+
+			logger.info(f"Daemon stopped after serving {self.sessions_served} sessions")
+
+	def _idle(self) -> bool:
+		with self._lock:
+			return self.sessions == 0 and time.monotonic() - self._last_activity > self.idle_timeout
+
+	def _handle(self, connection : Connection):
+		with self._lock:
+			self.sessions += 1
+
+		try:
+			message = connection.receive()
+			if message is None:
+				return
+
+			if message["type"] == "shutdown":
+				self._stopping = True
+				connection.send("exit", code=0)
+			elif message["type"] == "start":
+				self._run_session(connection, message)
+		except (BrokenPipeError, ConnectionError):
+			logger.info("Client disconnected")
+		except Exception:
+			logger.exception("Daemon session failed")
+		finally:
+			connection.close()
+			with self._lock:
+				self.sessions -= 1
+				self.sessions_served += 1
+				self._last_activity = time.monotonic()
+
+	def _run_session(self, connection : Connection, start : dict):
+		from . import create_chatbot
+		from .remote import RemoteChatbot
+		environment.use(environment.Environment(start["cwd"], start["env"], start["terminal_size"]))
+		options = start["options"]
+		logger.info(f"Starting session in {start['cwd']}")
+
+		chatbot : 'RemoteChatbot' = None
+		code, goodbye = 0, False
+		try:
+			chatbot = create_chatbot(self.config, chatbot_class=RemoteChatbot, connection=connection, **options["chatbot"])
+			chatbot.start(options["prompt"])
+		except SystemExit as e:
+			code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+		except (EOFError, KeyboardInterrupt):
+			goodbye = True
+		except (BrokenPipeError, ConnectionError):
+			raise
+		except Exception as e:
+			logger.exception("Session failed")
+			connection.send("output", stream="stderr", text=f"ERR: {e.__class__.__name__}: {e}\n")
+			code = 1
+		finally:
+			if chatbot is not None:
+				if chatbot.conversation.session is not None:
+					chatbot.conversation.session.close()
+				if chatbot.shell is not None:
+					chatbot.shell.close()
+				if chatbot.cache is not None:
+					chatbot.cache.close()
+				if chatbot.recipes is not None:
+					chatbot.recipes.close()
+
+		connection.send("exit", code=code, goodbye=goodbye)
+
+
+def connect(path : str=SOCKET_PATH) -> Connection:
+	"""Connects to the running daemon, or returns None if there isn't one"""
+	if not os.path.exists(path):
+		return None
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except OSError:
+		sock.close()
+		return None
+
+	return Connection(sock)
+
+def run_client(connection : Connection, prompt : str, chatbot_options : dict) -> int:
+	"""Runs a session in the daemon from this terminal, and returns its exit code"""
+	connection.send(
+		"start",
+		options={ "prompt": prompt, "chatbot": chatbot_options },
+		cwd=os.getcwd(),
+		env=dict(os.environ),
+		terminal_size=tuple(get_terminal_size())
+	)
+
+	interrupted = False
+	try:
+		while True:
+			try:
+				message = connection.receive()
+			except KeyboardInterrupt:
+				if interrupted:
+					raise
+
+				# Stops the commands running in the daemon for this prompt. Pressing Ctrl-C again disconnects
+				connection.send("interrupt")
+				interrupted = True
+				continue
+
+			if message is None:
+				raise ConnectionError("The gptdo daemon closed the connection")
+
+			if message["type"] == "output":
+				stream = sys.stderr if message["stream"] == "stderr" else sys.stdout
+				stream.write(message["text"])
+				stream.flush()
+
+			elif message["type"] == "input":
+				interrupted = False
+				try:
+					connection.send("input", text=input(message["prompt"]))
+				except EOFError:
+					connection.send("eof")
+
+			elif message["type"] == "exit":
+				if message.get("goodbye"):
+					raise EOFError()
+
+				return message["code"]
+	finally:
+		connection.close()
+
+def stop() -> bool:
+	connection = connect()
+	if connection is None:
+		return False
+
+	try:
+		connection.send("shutdown")
+		connection.receive()
+	finally:
+		connection.close()
+
+	return True
+
+def start(loglevel=0, idle_timeout : float=DEFAULT_IDLE_TIMEOUT, foreground : bool=False):
+	"""Starts the daemon, in the background unless `foreground` is set"""
+	from . import load_config, setup_logging
+
+	existing = connect()
+	if existing is not None:
+		existing.close()
+		print(f"gptdo daemon is already running ({SOCKET_PATH})")
+		return
+
+	config = load_config()
+	setup_logging(loglevel)
+
+	if not foreground:
+		pid = os.fork()
+		if pid:
+			print(f"gptdo daemon started (pid {pid}, idle timeout {idle_timeout}s)")
+			return
+
+		# Detach from the terminal, so that closing it doesn't stop the daemon
+		os.setsid()
+		devnull = os.open(os.devnull, os.O_RDWR)
+		for fd in range(3):
+			os.dup2(devnull, fd)
+		os.close(devnull)
+
+	try:
+		Daemon(config, idle_timeout=idle_timeout).serve()
+	except Exception:
+		logger.exception("Daemon failed")
+		raise
+	finally:
+		if not foreground:
+			os._exit(0)
@@ -0,0 +1,35 @@
+import os
+from contextvars import ContextVar
+from shutil import get_terminal_size
+
+class Environment:
+	"""The working directory, environment variables and terminal size a prompt was asked in
+
+	These are normally this process's own. The daemon (see daemon.py) serves several terminals at once though, so each
+	of its sessions runs with the environment of the client which started it.
+	"""
+	def __init__(self, cwd : str, env : dict, terminal_size : 'tuple[int, int]'):
+		self.cwd = cwd
+		self.env = env
+		self.terminal_size = os.terminal_size(terminal_size)
+
+_current : 'ContextVar[Environment]' = ContextVar("gptdo_environment", default=None)
+
+def use(environment : Environment):
+	"""Sets the environment of the current thread. Work handed to a pool must be run with `contextvars.copy_context()`"""
+	_current.set(environment)
+
+def current() -> Environment:
+	return _current.get()
+
+def getcwd() -> str:
+	environment = _current.get()
+	return environment.cwd if environment else os.getcwd()
+
+def environ() -> dict:
+	environment = _current.get()
+	return environment.env if environment else os.environ
+
+def terminal_size() -> os.terminal_size:
+	environment = _current.get()
+	return environment.terminal_size if environment else get_terminal_size()
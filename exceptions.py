@@ -15,12 +15,14 @@ class CommandCancelled(GPTDoException):
 		super().__init__(message)
 
 class CommandFailed(GPTDoException):
-	def __init__(self, message, stdout, stderr, exit_code):
+	def __init__(self, message, stdout, stderr, exit_code, captures=None):
 		super().__init__(message)
 
 		self.stdout = stdout
 		self.stderr = stderr
 		self.exit_code = exit_code
+		# The OutputCaptures of stdout and stderr, if the output was captured
+		self.captures = captures
 	
 	def to_function_content(self):
 		output = super().to_function_content()
@@ -36,4 +38,30 @@ EXIT CODE:
 {self.exit_code}
 """
 
-		return output
\ No newline at end of file
+		return output
+
+class CommandTimedOut(CommandFailed):
+	def __init__(self, message, stdout, stderr, exit_code, reason, elapsed, limit, captures=None):
+		super().__init__(message, stdout, stderr, exit_code, captures=captures)
+
+		# "timeout" or "idle_timeout"
+		self.reason = reason
+		self.elapsed = elapsed
+		self.limit = limit
+
+	def describe(self):
+		if self.reason == "idle_timeout":
+			return f"no output for {self.limit:.0f}s, stopped after {self.elapsed:.1f}s"
+		return f"timed out after {self.limit:.0f}s"
+
+class RequestFailed(GPTDoException):
+	def __init__(self, message):
+		super().__init__(message)
+
+class CircuitOpen(RequestFailed):
+	def __init__(self, message):
+		super().__init__(message)
+
+class SessionNotFound(GPTDoException):
+	def __init__(self, message):
+		super().__init__(message)
@@ -0,0 +1,463 @@
+import os
+import sys
+import time
+import uuid
+import codecs
+import signal
+import logging
+import selectors
+import threading
+import subprocess
+from .capture import OutputCapture
+from . import environment
+
+logger = logging.getLogger("gptdo")
+
+READ_CHUNK_SIZE = 65536
+
+# Seconds a stopped process group is given to exit after SIGTERM, before it is sent SIGKILL
+KILL_GRACE_PERIOD = 2.0
+
+# How often a running command checks whether it has been cancelled from another thread
+CANCEL_POLL_INTERVAL = 0.1
+
+# Why a command was stopped before it finished
+TIMEOUT = "timeout"
+IDLE_TIMEOUT = "idle_timeout"
+CANCELLED = "cancelled"
+
+class ResourceLimits:
+	"""Limits on the CPU time and the memory of each process of a command, set with bash's `ulimit`"""
+	def __init__(self, cpu_seconds : int=None, memory_bytes : int=None):
+		self.cpu_seconds = cpu_seconds
+		self.memory_bytes = memory_bytes
+
+	def __bool__(self) -> bool:
+		return bool(self.cpu_seconds or self.memory_bytes)
+
+	def prefix(self) -> str:
+		"""The commands to run first in the shell which runs the command"""
+		prefix = ""
+		if self.cpu_seconds:
+			prefix += f"ulimit -t {int(self.cpu_seconds)}; "
+		if self.memory_bytes:
+			prefix += f"ulimit -v {int(self.memory_bytes) // 1024}; "
+		return prefix
+
+
+class CommandResult:
+	def __init__(self, command : str, exit_code : int, stdout : OutputCapture, stderr : OutputCapture, wall_time : float, bytes_read : int, io_wait : float, stopped : str=None):
+		self.command = command
+		self.exit_code = exit_code
+		self.stdout = stdout
+		self.stderr = stderr
+		self.wall_time = wall_time
+		self.bytes_read = bytes_read
+		self.io_wait = io_wait
+		# TIMEOUT or IDLE_TIMEOUT if the command ran out of time and was killed
+		self.stopped = stopped
+
+	@property
+	def metrics(self) -> dict:
+		return {
+			"command": self.command,
+			"exit_code": self.exit_code,
+			"wall_time": self.wall_time,
+			"bytes_read": self.bytes_read,
+			"io_wait": self.io_wait,
+			"stopped": self.stopped,
+		}
+
+	def log_metrics(self):
+		stopped = f" (stopped: {self.stopped})" if self.stopped else ""
+		logger.info(f"Command finished in {self.wall_time * 1000:.0f}ms{stopped}: exit code {self.exit_code}, {self.bytes_read} bytes read, {self.io_wait * 1000:.0f}ms blocked on I/O")
+
+
+class Deadline:
+	"""The wall-clock and idle-output timeouts of a command, either of which may be None for no limit
+
+	If `cancel` is given, the command is also stopped (within CANCEL_POLL_INTERVAL) once that event is set, e.g. by
+	the thread handling Ctrl-C while the command runs in another one.
+	"""
+	def __init__(self, start : float, timeout : float=None, idle_timeout : float=None, cancel : threading.Event=None):
+		self.start = start
+		self.timeout = timeout
+		self.idle_timeout = idle_timeout
+		self.cancel = cancel
+		self.last_activity = start
+
+	def touch(self):
+		self.last_activity = time.perf_counter()
+
+	def remaining(self) -> float:
+		"""Seconds until the next timeout, or None if there is none"""
+		now = time.perf_counter()
+		remaining = [
+			limit - (now - since)
+			for limit, since in [(self.timeout, self.start), (self.idle_timeout, self.last_activity)]
+			if limit
+		]
+		if self.cancel is not None:
+			remaining.append(CANCEL_POLL_INTERVAL)
+		return max(min(remaining), 0.0) if remaining else None
+
+	def expired(self) -> str:
+		now = time.perf_counter()
+		if self.cancel is not None and self.cancel.is_set():
+			return CANCELLED
+		if self.timeout and now - self.start >= self.timeout:
+			return TIMEOUT
+		if self.idle_timeout and now - self.last_activity >= self.idle_timeout:
+			return IDLE_TIMEOUT
+		return None
+
+
+def stop_process(process : subprocess.Popen, grace : float=KILL_GRACE_PERIOD):
+	"""Stops a process which leads its own process group, and every other process of the group
+
+	SIGTERM is sent first. Whatever is still running `grace` seconds later is sent SIGKILL.
+	"""
+	def send(sig) -> bool:
+		try:
+			os.killpg(process.pid, sig)
+			return True
+		except (ProcessLookupError, PermissionError):
+			return False
+
+	send(signal.SIGTERM)
+	give_up = time.perf_counter() + grace
+	while time.perf_counter() < give_up:
+		# Reaps the leader, so that it doesn't keep the group alive as a zombie
+		process.poll()
+		if not send(0):
+			break
+		time.sleep(0.05)
+	else:
+		logger.warning(f"Process {process.pid} did not exit within {grace}s of SIGTERM, killing it")
+		send(signal.SIGKILL)
+
+	process.wait()
+
+
+class OutputPump:
+	"""Drains a process's stdout and stderr concurrently with a selector, in large chunks
+
+	Each chunk is decoded, captured, and passed to `on_output(stream_name, text, elapsed)` in the order it was read.
+	If `forward_stdin` is set, whatever the user types is forwarded to the process until they send EOF (Ctrl-D).
+	"""
+	def __init__(self, on_output=None, forward_stdin : bool=False):
+		self.on_output = on_output
+		self.forward_stdin = forward_stdin
+		self.bytes_read = 0
+		self.io_wait = 0.0
+
+	def run(self, process : subprocess.Popen, stdout : OutputCapture, stderr : OutputCapture, start : float, deadline : Deadline=None) -> str:
+		"""Pumps the output until both streams are closed, or until `deadline` expires, in which case it returns why"""
+		deadline = deadline or Deadline(start)
+		selector = selectors.DefaultSelector()
+		decoder = codecs.getincrementaldecoder("utf-8")
+		streams = 0
+		for pipe, capture in [(process.stdout, stdout), (process.stderr, stderr)]:
+			selector.register(pipe, selectors.EVENT_READ, (capture, decoder(errors="replace")))
+			streams += 1
+
+		if self.forward_stdin and process.stdin is not None:
+			selector.register(sys.stdin, selectors.EVENT_READ, None)
+
+		try:
+			while streams:
+				wait_start = time.perf_counter()
+				events = selector.select(deadline.remaining())
+				self.io_wait += time.perf_counter() - wait_start
+
+				if not events:
+					expired = deadline.expired()
+					if expired:
+						return expired
+					continue
+
+				deadline.touch()
+				for key, _ in events:
+					if key.data is None:
+						self._forward_stdin(selector, process)
+						continue
+
+					capture, stream_decoder = key.data
+					data = os.read(key.fd, READ_CHUNK_SIZE)
+					if not data:
+						selector.unregister(key.fileobj)
+						streams -= 1
+						self.emit(capture, stream_decoder.decode(b"", final=True), start)
+						continue
+
+					self.bytes_read += len(data)
+					self.emit(capture, stream_decoder.decode(data), start)
+
+			return None
+		finally:
+			selector.close()
+			if process.stdin is not None and not process.stdin.closed:
+				try:
+					process.stdin.close()
+				except BrokenPipeError:
+					pass
+
+	def emit(self, capture : OutputCapture, text : str, start : float):
+		if not text:
+			return
+
+		capture.write(text)
+		if self.on_output:
+			self.on_output(capture.name, text, time.perf_counter() - start)
+
+	def _forward_stdin(self, selector : selectors.BaseSelector, process : subprocess.Popen):
+		data = os.read(sys.stdin.fileno(), READ_CHUNK_SIZE)
+		try:
+			if not data:
+				process.stdin.close()
+			else:
+				process.stdin.write(data)
+				process.stdin.flush()
+				return
+		except BrokenPipeError:
+			pass
+
+		selector.unregister(sys.stdin)
+
+
+def _own_process_group() -> dict:
+	"""Popen arguments which start a process in a new process group, but in gptdo's session (and terminal)"""
+	if sys.version_info >= (3, 11):
+		return { "process_group": 0 }
+	return { "preexec_fn": os.setpgrp }
+
+def run_process(command : str, on_output=None, forward_stdin : bool=False, timeout : float=None, idle_timeout : float=None, limits : ResourceLimits=None, cancel : threading.Event=None) -> CommandResult:
+	"""Runs a command in a new bash shell, pumping its output through `on_output` as it is produced
+
+	stdin is closed unless `forward_stdin` is set, so commands waiting on input fail instead of hanging. The command runs
+	in the current environment's working directory and with its variables (see environment.py).
+
+	The command runs in a process group of its own, so that it can be stopped along with every process it started,
+	once it has run for `timeout` seconds or `idle_timeout` seconds have passed without any output (or input), or once
+	`cancel` is set. It also runs in a session of its own (without a controlling terminal), unless its input is
+	forwarded: it then stays in gptdo's session, but as a background group, in which reading from (or configuring) the
+	terminal directly fails instead of stopping the command.
+	"""
+	start = time.perf_counter()
+	stdout = OutputCapture("stdout")
+	stderr = OutputCapture("stderr")
+	pump = OutputPump(on_output=on_output, forward_stdin=forward_stdin)
+	deadline = Deadline(start, timeout=timeout, idle_timeout=idle_timeout, cancel=cancel)
+
+	prefix = limits.prefix() if limits else ""
+	if forward_stdin:
+		# Ignored signals stay ignored in the processes the shell starts
+		prefix += "trap '' TTIN TTOU; "
+
+	process = subprocess.Popen(
+		prefix + command,
+		shell=True,
+		executable="/bin/bash",
+		cwd=environment.getcwd(),
+		env=environment.environ(),
+		stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE,
+		stdin=subprocess.PIPE if forward_stdin else subprocess.DEVNULL,
+		start_new_session=not forward_stdin,
+		bufsize=0,
+		**(_own_process_group() if forward_stdin else {})
+	)
+
+	try:
+		stopped = pump.run(process, stdout, stderr, start, deadline)
+		# The output is closed, but the command may still be running (e.g. with its output redirected)
+		while stopped is None:
+			try:
+				process.wait(timeout=deadline.remaining())
+				break
+			except subprocess.TimeoutExpired:
+				stopped = deadline.expired()
+
+		if stopped is not None:
+			logger.warning(f"Stopping command after {time.perf_counter() - start:.1f}s ({stopped}): {command}")
+			stop_process(process)
+	except KeyboardInterrupt:
+		stop_process(process)
+		raise
+	finally:
+		stdout.close()
+		stderr.close()
+		for pipe in [process.stdout, process.stderr]:
+			pipe.close()
+
+	return CommandResult(command, process.returncode, stdout, stderr, time.perf_counter() - start, pump.bytes_read, pump.io_wait, stopped=stopped)
+
+
+class ShellSession:
+	"""A long-lived bash process which runs commands one after another
+
+	This avoids starting a new shell for every command, and lets the working directory and exported variables carry
+	over from one command to the next. Each command is followed by unique sentinels on stdout and stderr, which mark
+	the end of its output and carry its exit code and the shell's new working directory.
+
+	If a command kills the shell (e.g. `exit`), a new one is started in the last known working directory for the next
+	command, although exported variables are lost. Commands can't read from stdin, which is used to send them to the shell.
+	The shell runs in a session of its own, so a command which runs out of time is stopped by stopping the whole shell.
+	"""
+	def __init__(self, cwd : str=None, env : dict=None, limits : ResourceLimits=None):
+		self.cwd = cwd or environment.getcwd()
+		self.env = env if env is not None else dict(environment.environ())
+		self.limits = limits
+		self.commands_run = 0
+		self._process : subprocess.Popen = None
+
+	@property
+	def alive(self) -> bool:
+		return self._process is not None and self._process.poll() is None
+
+	def _start(self):
+		logger.debug(f"Starting persistent shell in {self.cwd}")
+		self._process = subprocess.Popen(
+			["/bin/bash", "--noprofile", "--norc"],
+			cwd=self.cwd,
+			env=self.env,
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			start_new_session=True,
+			bufsize=0
+		)
+
+	def close(self):
+		if self.alive:
+			self._process.stdin.close()
+			stop_process(self._process)
+
+		self._process = None
+
+	def run(self, command : str, on_output=None, timeout : float=None, idle_timeout : float=None, cancel : threading.Event=None) -> CommandResult:
+		start = time.perf_counter()
+		if not self.alive:
+			if self._process is not None:
+				logger.warning(f"Persistent shell exited with code {self._process.returncode}, restarting it in {self.cwd}")
+			self._start()
+
+		if self.limits:
+			# Limits set in the shell itself would apply to the shell, and so to all its commands combined. Each command
+			# runs in a limited subshell instead (its output going to the shell's stdout through fd 9), which hands its
+			# exported variables (including those it unset) and working directory back to the shell
+			run = (
+				f"{{ __gptdo_state=$( ( __gptdo_exported=$(compgen -e); {self.limits.prefix()}"
+				f"eval \"$__gptdo_command\" < /dev/null >&9 9>&-; __gptdo_status=$?; "
+				f"printf 'unset -v %s\\n' $__gptdo_exported; export -p; printf 'cd -- %q\\n' \"$PWD\"; exit $__gptdo_status ) ); "
+				f"__gptdo_status=$?; }} 9>&1\n"
+				f"eval \"$__gptdo_state\" 2> /dev/null\n"
+			)
+		else:
+			run = f"eval \"$__gptdo_command\" < /dev/null\n__gptdo_status=$?\n"
+
+		marker = f"__GPTDO_{uuid.uuid4().hex}__"
+		# The command is read verbatim through a quoted heredoc and eval'd, so that a syntax error in it can't break the framing
+		script = (
+			f"IFS= read -r -d '' __gptdo_command <<'{marker}'\n{command}\n{marker}\n"
+			f"{run}"
+			f"printf '\\n{marker} %d %s\\n' \"$__gptdo_status\" \"$PWD\"\n"
+			f"printf '\\n{marker}\\n' >&2\n"
+		)
+
+		stdout = OutputCapture("stdout")
+		stderr = OutputCapture("stderr")
+		pump = OutputPump(on_output=on_output)
+		deadline = Deadline(start, timeout=timeout, idle_timeout=idle_timeout, cancel=cancel)
+		stopped = None
+
+		try:
+			self._process.stdin.write(script.encode("utf-8"))
+			self._process.stdin.flush()
+			exit_code, stopped = self._read_until_marker(marker, pump, stdout, stderr, start, deadline)
+		except BrokenPipeError:
+			exit_code = self._process.wait()
+		except KeyboardInterrupt:
+			self.close()
+			raise
+		finally:
+			stdout.close()
+			stderr.close()
+
+		if stopped is not None:
+			logger.warning(f"Stopping the persistent shell after {time.perf_counter() - start:.1f}s ({stopped}): {command}")
+			process = self._process
+			self.close()
+			exit_code = process.returncode
+
+		self.commands_run += 1
+		return CommandResult(command, exit_code, stdout, stderr, time.perf_counter() - start, pump.bytes_read, pump.io_wait, stopped=stopped)
+
+	def _read_until_marker(self, marker : str, pump : OutputPump, stdout : OutputCapture, stderr : OutputCapture, start : float, deadline : Deadline) -> 'tuple[int, str]':
+		"""The exit code of the command, or the reason it was stopped if `deadline` expired before it finished"""
+		selector = selectors.DefaultSelector()
+		decoder = codecs.getincrementaldecoder("utf-8")
+		pending = {}
+		for pipe, capture in [(self._process.stdout, stdout), (self._process.stderr, stderr)]:
+			selector.register(pipe, selectors.EVENT_READ, (capture, decoder(errors="replace")))
+			pending[capture.name] = ""
+
+		sentinel = "\n" + marker
+		exit_code = None
+		try:
+			while selector.get_map():
+				wait_start = time.perf_counter()
+				events = selector.select(deadline.remaining())
+				pump.io_wait += time.perf_counter() - wait_start
+
+				if not events:
+					expired = deadline.expired()
+					if expired:
+						for capture in [stdout, stderr]:
+							pump.emit(capture, pending[capture.name], start)
+						return None, expired
+					continue
+
+				deadline.touch()
+				for key, _ in events:
+					capture, stream_decoder = key.data
+					data = os.read(key.fd, READ_CHUNK_SIZE)
+					if not data:
+						# The shell died before finishing the command
+						selector.unregister(key.fileobj)
+						pump.emit(capture, pending[capture.name] + stream_decoder.decode(b"", final=True), start)
+						pending[capture.name] = ""
+						continue
+
+					pump.bytes_read += len(data)
+					text = pending[capture.name] + stream_decoder.decode(data)
+
+					index = text.find(sentinel)
+					if index < 0:
+						# Hold back anything which could be the start of a sentinel split across reads
+						safe = max(len(text) - len(sentinel), 0)
+						pump.emit(capture, text[:safe], start)
+						pending[capture.name] = text[safe:]
+						continue
+
+					end = text.find("\n", index + len(sentinel))
+					if end < 0:
+						pump.emit(capture, text[:index], start)
+						pending[capture.name] = text[index:]
+						continue
+
+					pump.emit(capture, text[:index], start)
+					pending[capture.name] = ""
+					selector.unregister(key.fileobj)
+
+					if capture is stdout:
+						status, _, cwd = text[index + len(sentinel):end].strip().partition(" ")
+						exit_code = int(status)
+						self.cwd = cwd or self.cwd
+		finally:
+			selector.close()
+
+		if exit_code is None:
+			exit_code = self._process.wait()
+
+		return exit_code, None
@@ -1,27 +1,40 @@
-import subprocess
+import json
+import time
 import logging
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from .chatbot import GPTDoChatbot
-from . import exceptions as gptdo_exc, util
+from .capture import read_command_output
+from .executor import run_process, TIMEOUT, CANCELLED
+from . import inventory, tracing, exceptions as gptdo_exc
 
 logger = logging.getLogger("gptdo")
 
+MAX_CONCURRENT_COMMANDS = 8
+
+# Default (wall-clock, idle-output) timeouts in seconds of each command, by function. Can be changed with
+# GPTDO_CONTEXT_COMMAND_TIMEOUT, GPTDO_CONTEXT_COMMAND_IDLE_TIMEOUT, GPTDO_COMMAND_TIMEOUT and GPTDO_COMMAND_IDLE_TIMEOUT
+DEFAULT_CONTEXT_COMMAND_TIMEOUTS = (60, 30)
+DEFAULT_COMMAND_TIMEOUTS = (1800, 300)
+
 RUN_COMMAND_PARAMETERS = {
 	"type": "object",
+	# stream_stdout_to_user comes first so that it is known before the first command is streamed in
 	"properties": {
+		"stream_stdout_to_user": {
+			"type": "boolean",
+			"description": "Should be True if the stdout is relevant to the user's task. If false, stdout will be hidden from the user, but visible to you to help craft your response.",
+			"default": False
+		},
 		"commands": {
 			"type": "array",
 			"description": "The list of commands to run",
 			"items": {
 				"type": "string"
 			}
-		},
-		"stream_stdout_to_user": {
-			"type": "boolean",
-			"description": "Should be True if the stdout is relevant to the user's task. If false, stdout will be hidden from the user, but visible to you to help craft your response.",
-			"default": False
 		}
 	},
-	"required": ["commands", "stream_stdout_to_user"]
+	"required": ["stream_stdout_to_user", "commands"]
 }
 
 FUNC_RUN_COMMANDS = {
@@ -36,121 +49,445 @@ FUNC_RUN_COMMANDS_FOR_CONTEXT = {
 	"parameters": RUN_COMMAND_PARAMETERS
 }
 
-def process_func_run_commands(chatbot : GPTDoChatbot, commands : 'list[str]', stream_stdout_to_user : bool=False):
-	success, content = _process_suggested_commands(chatbot, commands, stream_stdout_to_user=stream_stdout_to_user)
-	chatbot.conversation.add_function_call(FUNC_RUN_COMMANDS["name"], content)
-	chatbot.conversation.initialize_context()
-	return success
+FUNC_READ_COMMAND_OUTPUT = {
+	"name": "read_command_output",
+	"description": "Read the full output of an earlier command whose output was truncated, either by line offset or by searching it with a regular expression",
+	"parameters": {
+		"type": "object",
+		"properties": {
+			"output_id": {
+				"type": "integer",
+				"description": "The output_id given in the truncated output"
+			},
+			"offset": {
+				"type": "integer",
+				"description": "Number of lines (or of matching lines, if a pattern is given) to skip",
+				"default": 0
+			},
+			"limit": {
+				"type": "integer",
+				"description": "Maximum number of lines to return",
+				"default": 100
+			},
+			"pattern": {
+				"type": "string",
+				"description": "Optional regular expression. If given, only the lines matching it are returned"
+			}
+		},
+		"required": ["output_id"]
+	}
+}
+
+FUNC_FIND_INSTALLED_PACKAGES = {
+	"name": "find_installed_packages",
+	"description": "Look up installed Python distributions and system (dpkg) packages by name, without running any command. Returns the version of each package with that name, or else of the packages whose name contains it",
+	"parameters": {
+		"type": "object",
+		"properties": {
+			"names": {
+				"type": "array",
+				"description": "The package names (or parts of names) to look up",
+				"items": {
+					"type": "string"
+				}
+			},
+			"source": {
+				"type": "string",
+				"enum": ["any", "python", "system"],
+				"description": "Only look up Python distributions, or system packages",
+				"default": "any"
+			}
+		},
+		"required": ["names"]
+	}
+}
+
+TOOLS = [{ "type": "function", "function": function } for function in [FUNC_RUN_COMMANDS, FUNC_RUN_COMMANDS_FOR_CONTEXT, FUNC_READ_COMMAND_OUTPUT, FUNC_FIND_INSTALLED_PACKAGES]]
+
+RUN_COMMAND_FUNCTIONS = [FUNC_RUN_COMMANDS["name"], FUNC_RUN_COMMANDS_FOR_CONTEXT["name"]]
+
+DEFAULT_TIMEOUTS = {
+	FUNC_RUN_COMMANDS["name"]: DEFAULT_COMMAND_TIMEOUTS,
+	FUNC_RUN_COMMANDS_FOR_CONTEXT["name"]: DEFAULT_CONTEXT_COMMAND_TIMEOUTS,
+}
 
-def _process_suggested_commands(chatbot : GPTDoChatbot, commands : 'list[str]', stream_stdout_to_user : bool=False):
-	log = "Commands Run:\n"
-	recap_msg = ""
-	stdout = "Combined stdout:\n"
-	stderr = "Combined stderr:\n"
-	instructions = "Instructions:\n"
+def process_tool_calls(chatbot : GPTDoChatbot, calls : 'list[tuple]', batches : 'dict[int, CommandBatch]'=None) -> bool:
+	"""Runs the (tool call, parsed arguments) of a response, and adds each result to the conversation as a tool message
 
-	failed = False
+	The calls whose commands are run concurrently (see `create_batch`) are all started first, so they run alongside each
+	other and alongside the rest of the calls, which are run one after the other, in order. Once a command of those
+	stops its call (by failing, or being refused), the later calls running commands one after the other are skipped, as
+	the rest of its own commands are. `batches` holds the batches already started while the response was streamed in,
+	by index of their call.
+	"""
+	batches = dict(batches or {})
+	results : 'dict[int, tuple[bool, str]]' = {}
+	stopped_by : CommandBatch = None
 
-	logger.info(f"Stream stdout: {stream_stdout_to_user}")
-	logger.info(f"Auto approve: {chatbot.auto_approve}")
+	with tracing.span("tool_calls", calls=len(calls)):
+		for i, (call, arguments) in enumerate(calls):
+			if call.function.name in RUN_COMMAND_FUNCTIONS:
+				if i not in batches:
+					batches[i] = create_batch(chatbot, call.function.name, stream_stdout_to_user=arguments.get("stream_stdout_to_user", False))
+				if batches[i].concurrent:
+					_dispatch_commands(batches[i], arguments["commands"][batches[i].dispatched:])
 
-	logger.info(f"Recommended commands:")
-	logger.info(" > " + "\n > ".join(commands))
+		for i, (call, arguments) in enumerate(calls):
+			name = call.function.name
+			if name == FUNC_READ_COMMAND_OUTPUT["name"]:
+				results[i] = process_func_read_command_output(chatbot, arguments)
+			elif name == FUNC_FIND_INSTALLED_PACKAGES["name"]:
+				results[i] = process_func_find_installed_packages(chatbot, arguments)
+			elif name not in RUN_COMMAND_FUNCTIONS:
+				results[i] = False, f"Unknown function: {name}"
+			elif not batches[i].concurrent and stopped_by is not None:
+				results[i] = False, skipped_call_content(stopped_by)
+				del batches[i]
+			elif not batches[i].concurrent:
+				results[i] = process_func_run_commands(chatbot, arguments["commands"], batch=batches[i])
+				if batches[i].stopped:
+					stopped_by = batches[i]
+
+		for i, batch in batches.items():
+			if batch.concurrent:
+				results[i] = batch.finish()
+
+		for i, (call, _) in enumerate(calls):
+			if i in batches:
+				chatbot.on_commands_run(batches[i].function_name, batches[i].commands, results[i][0] and not batches[i].cancelled)
+			elif call.function.name not in RUN_COMMAND_FUNCTIONS:
+				chatbot.on_commands_run(call.function.name, [], results[i][0])
+
+	for i, (call, _) in enumerate(calls):
+		chatbot.conversation.add_tool_result(call.id, results[i][1])
+
+	return all(success for success, _ in results.values())
+
+def skipped_call_content(stopped_by : 'CommandBatch') -> str:
+	return f"None of these commands were run, because an earlier command ({stopped_by.commands[-1]}) {stopped_by.stop_reason}."
+
+def process_func_read_command_output(chatbot : GPTDoChatbot, arguments : dict) -> 'tuple[bool, str]':
+	content = read_command_output(
+		arguments["output_id"],
+		offset=arguments.get("offset", 0),
+		limit=arguments.get("limit", 100),
+		pattern=arguments.get("pattern"),
+		capture=chatbot.outputs.get(arguments["output_id"])
+	)
+
+	return True, content
+
+def process_func_find_installed_packages(chatbot : GPTDoChatbot, arguments : dict) -> 'tuple[bool, str]':
+	packages = inventory.get_inventory()
+	results = {}
+	with tracing.span("inventory.lookup", names=len(arguments["names"])):
+		for name in arguments["names"]:
+			results[name] = packages.lookup(name, source=arguments.get("source", "any")) or "Not installed"
+
+	return True, json.dumps(results)
+
+def process_func_run_commands(chatbot : GPTDoChatbot, commands : 'list[str]', stream_stdout_to_user : bool=False, batch : 'CommandBatch'=None, function_name : str=FUNC_RUN_COMMANDS["name"]) -> 'tuple[bool, str]':
+	"""Runs the commands of a tool call, returning whether they all succeeded and the output for the model
+
+	`batch` may already have run some of the commands (e.g. if they were dispatched while the call was being streamed),
+	in which case only the remaining commands are run.
+	"""
+	if batch is None:
+		batch = create_batch(chatbot, function_name, stream_stdout_to_user=stream_stdout_to_user)
+
+	return _process_suggested_commands(chatbot, commands[batch.dispatched:], batch=batch)
+
+def create_batch(chatbot : GPTDoChatbot, function_name : str, stream_stdout_to_user : bool=False) -> 'CommandBatch':
+	"""Creates the batch for a tool call's commands
+
+	Commands run to gain context are read-only discovery commands, so they are run concurrently unless their output is
+	streamed to the user, or they have to run one after the other in the persistent shell.
+	"""
+	concurrent = (
+		function_name == FUNC_RUN_COMMANDS_FOR_CONTEXT["name"]
+		and not stream_stdout_to_user
+		and chatbot.shell is None
+	)
+
+	return CommandBatch(chatbot, stream_stdout_to_user=stream_stdout_to_user, concurrent=concurrent, function_name=function_name)
+
+def _process_suggested_commands(chatbot : GPTDoChatbot, commands : 'list[str]', stream_stdout_to_user : bool=False, batch : 'CommandBatch'=None):
+	if batch is None:
+		batch = CommandBatch(chatbot, stream_stdout_to_user=stream_stdout_to_user)
+
+	_dispatch_commands(batch, commands)
+	return batch.finish()
+
+def _dispatch_commands(batch : 'CommandBatch', commands : 'list[str]'):
+	if commands and not batch.stopped:
+		logger.info(f"Recommended commands:")
+		logger.info(" > " + "\n > ".join(commands))
 
 	for command in commands:
+		if not batch.run(command):
+			break
+
+class CommandBatch:
+	"""The commands of a single tool call
+
+	Commands can be run as soon as they are known (e.g. while the rest of a streamed tool call is still being
+	generated). `finish` then builds the function output for the model. If `approved` is set, the user has already
+	approved the batch as a whole, and isn't asked again for each command.
+
+	Commands are normally run one at a time, stopping at the first failure. If `concurrent` is set, each command is
+	approved as it is added, then run on a pool of up to MAX_CONCURRENT_COMMANDS workers; every approved command is run,
+	and the results are reported in the original order once they are all done.
+	"""
+	def __init__(self, chatbot : GPTDoChatbot, stream_stdout_to_user : bool=False, concurrent : bool=False, function_name : str=FUNC_RUN_COMMANDS["name"], approved : bool=False):
+		self.chatbot = chatbot
+		self.stream_stdout_to_user = stream_stdout_to_user
+		self.concurrent = concurrent
+		self.approved = approved
+		self.function_name = function_name
+		self.timeout, self.idle_timeout = chatbot.command_timeouts.get(function_name, DEFAULT_TIMEOUTS.get(function_name, (None, None)))
+		self.commands : 'list[str]' = []
+		# Commands passed to `run` so far, including concurrent ones which aren't recorded in `commands` until `finish`
+		self.dispatched = 0
+
+		self.log = "Commands Run:\n"
+		self.recap_msg = ""
+		self.stdout = "Combined stdout:\n"
+		self.stderr = "Combined stderr:\n"
+		self.instructions = "Instructions:\n"
+
+		self.failed = False
+		self.stopped = False
+		# Cancelled commands don't fail the batch, but a task with any of them isn't saved as a recipe
+		self.cancelled = False
+		# Why the batch stopped before running all its commands, e.g. "failed"
+		self.stop_reason : str = None
+
+		self._pool : ThreadPoolExecutor = None
+		self._pending : 'list[tuple]' = []
+		self._start = time.perf_counter()
+
+		logger.info(f"Stream stdout: {stream_stdout_to_user}")
+		logger.info(f"Auto approve: {chatbot.auto_approve}")
+		logger.info(f"Concurrent: {concurrent}")
+
+	def run(self, command : str) -> bool:
+		"""Runs a single command, returning False if the rest of the batch should not be run"""
+		if self.stopped:
+			return False
+
+		self.dispatched += 1
+		if not self.concurrent:
+			return self._record(command, lambda: _run_command(self.chatbot, command, stream_stdout_to_user=self.stream_stdout_to_user, approved=self.approved, timeouts=(self.timeout, self.idle_timeout)))
+
+		try:
+			if not self.approved:
+				_approve_command(self.chatbot, command)
+		except gptdo_exc.RefusedToRunCommand as e:
+			self._pending.append((command, e))
+			self.stopped = True
+			return False
+
+		if self._pool is None:
+			self._pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COMMANDS, thread_name_prefix="gptdo-command")
+
+		future = self._pool.submit(contextvars.copy_context().run, _execute_command, self.chatbot, command, stream_stdout_to_user=self.stream_stdout_to_user, timeouts=(self.timeout, self.idle_timeout))
+		self._pending.append((command, future))
+		return True
+
+	def _record(self, command : str, outcome) -> bool:
+		self.commands.append(command)
+
 		try:
-			stdout, stderr = _run_command(chatbot, command, stream_stdout_to_user=stream_stdout_to_user)
-			log += f" - SUCCESS: {command}\n"
+			stdout, stderr = outcome()
+			self.log += f" - SUCCESS: {command}\n"
 			logger.info(f"- SUCCESS")
-			stdout += stdout
-			logger.debug(f" - stdout: {stdout}")
-			stderr += stderr
-			logger.debug(f" - stderr: {stderr}")
-		
+			self.stdout += self.chatbot.outputs.add(command, stdout)
+			logger.debug(f" - stdout: {stdout.text()}")
+			self.stderr += self.chatbot.outputs.add(command, stderr)
+			logger.debug(f" - stderr: {stderr.text()}")
+
 		except gptdo_exc.RefusedToRunCommand as e:
-			log += f" - REFUSED: {command}\n"
+			self.log += f" - REFUSED: {command}\n"
 			logger.info(f"- REFUSED")
-			instructions += f" - Acknowledge the user's refusal to run the command, and give the user the option to express their reasoning or to do something else."
-			failed = True
-			recap_msg = "The running of commands was interrupted by user."
-			break
+			self.instructions += f" - Acknowledge the user's refusal to run the command, and give the user the option to express their reasoning or to do something else."
+			self.failed = True
+			self.recap_msg = "The running of commands was interrupted by user."
+			self.stopped = True
+			self.stop_reason = "was refused by the user"
 
 		except gptdo_exc.CommandCancelled as e:
-			log += f" - CANCELLED: {command}\n"
+			self.log += f" - CANCELLED: {command}\n"
 			logger.info(f"- CANCELLED")
-			instructions += f" - Acknowledge the user's refusal to run the command, and give the user the option to express their reasoning or to do something else."
+			self.cancelled = True
+			self.instructions += f" - Acknowledge the user's refusal to run the command, and give the user the option to express their reasoning or to do something else."
 		
+		except gptdo_exc.CommandTimedOut as e:
+			self.log += f" - TIMED OUT ({e.describe()}): {command}\n"
+			logger.info(f"- TIMED OUT")
+			stdout, stderr = e.captures
+			self.stdout += self.chatbot.outputs.add(command, stdout)
+			self.stderr += self.chatbot.outputs.add(command, stderr)
+			self.instructions += f" - The command `{command}` was stopped (with every process it started) because it ran out of time, and its output may be incomplete."
+			self.instructions += f" - Don't run it again as is. If it runs until stopped (e.g. a server, `tail -f` or `watch`), either run a bounded variant (e.g. with `timeout`, `head` or a count option) or tell the user how to run it themselves"
+			if self.chatbot.shell is not None:
+				self.instructions += f" - The persistent shell was stopped with it: the next command runs in a new shell in {self.chatbot.shell.cwd}, without the variables exported earlier"
+			self.recap_msg = "Some of the commands failed." if self.concurrent else "Running of commands was stopped because a command timed out."
+			self.failed = True
+			self.stopped = True
+			self.stop_reason = "timed out"
+
 		except gptdo_exc.CommandFailed as e:
-			log += f" - FAILED (exit code={e.exit_code}): {command}\n"
+			self.log += f" - FAILED (exit code={e.exit_code}): {command}\n"
 			logger.info(f"- FAILED")
-			stdout += e.stdout
+			stdout, stderr = e.captures
+			self.stdout += self.chatbot.outputs.add(command, stdout)
 			logger.debug(f" - stdout: {e.stdout}")
-			stderr += e.stderr
+			self.stderr += self.chatbot.outputs.add(command, stderr)
 			logger.debug(f" - stderr: {e.stderr}")
-			instructions += f" - Try to provide an explanation of the failure, if possible"
-			instructions += f" - If there is a clear reason, try to run some other commands"
-			instructions += f" - If there is some extra context that may shed light on the cause of the issue, ask a followup question or run some commands that may give that information"
-			recap_msg = "Running of commands was stopped due to an error."
-			failed = True
-			break
+			if not self.failed:
+				self.instructions += f" - Try to provide an explanation of the failure, if possible"
+				self.instructions += f" - If there is a clear reason, try to run some other commands"
+				self.instructions += f" - If there is some extra context that may shed light on the cause of the issue, ask a followup question or run some commands that may give that information"
+			self.recap_msg = "Some of the commands failed." if self.concurrent else "Running of commands was stopped due to an error."
+			self.failed = True
+			self.stopped = True
+			self.stop_reason = "failed"
 
-	if not failed:
-		instructions += f" - If the task is complete, send a response to the user which indicates such"
-		instructions += f" - If there are more steps to the task, proceed in crafting your next response/command"
-		recap_msg = "All commands were run successfully!"
-		
-	func_output = f"""
-{log}
+		return not self.stopped
+
+	def _collect(self):
+		"""Records the outcome of every concurrently run command, in the order they were added"""
+		try:
+			for command, pending in self._pending:
+				if isinstance(pending, Exception):
+					self._record(command, _raise(pending))
+				else:
+					self._record(command, pending.result)
+		except KeyboardInterrupt:
+			# The commands run in process groups of their own, which the terminal's Ctrl-C doesn't reach, so those
+			# already running are stopped before giving up on them
+			self.chatbot.cancel_commands.set()
+			running = [pending for _, pending in self._pending if isinstance(pending, Future) and not pending.cancel()]
+			wait(running)
+			raise
+		finally:
+			self._pending = []
+			if self._pool is not None:
+				self._pool.shutdown(wait=False)
+
+	def finish(self):
+		if self.concurrent:
+			self._collect()
+			logger.info(f"Ran {len(self.commands)} commands concurrently in {(time.perf_counter() - self._start) * 1000:.0f}ms")
 
-{recap_msg}
+		if not self.failed:
+			self.instructions += f" - If the task is complete, send a response to the user which indicates such"
+			self.instructions += f" - If there are more steps to the task, proceed in crafting your next response/command"
+			self.recap_msg = "All commands were run successfully!"
 
-{stdout}
+		func_output = f"""
+{self.log}
 
-{stderr}
+{self.recap_msg}
 
-{instructions}
+{self.stdout}
+
+{self.stderr}
+
+{self.instructions}
 """
-	success = not failed
-	return success, func_output
+		success = not self.failed
+		return success, func_output
+
+def _raise(exception : Exception):
+	def outcome():
+		raise exception
+	return outcome
 
-def _run_command(chatbot : GPTDoChatbot, command, stream_stdout_to_user=False):
+def _run_command(chatbot : GPTDoChatbot, command, stream_stdout_to_user=False, approved=False, timeouts : tuple=(None, None)):
+	if not approved:
+		_approve_command(chatbot, command)
+	return _execute_command(chatbot, command, stream_stdout_to_user=stream_stdout_to_user, timeouts=timeouts)
+
+def _approve_command(chatbot : GPTDoChatbot, command : str):
 	if not chatbot.auto_approve:
 		choice = "~"
 		while choice.lower() not in ["", "y", "n"]:
-			choice = input(f"Run Command: {command}? (Y/n) ")
-			util.clear_and_return_to_previous_line()
+			choice = chatbot.input(f"Run Command: {command}? (Y/n) ")
+			chatbot.clear_and_return_to_previous_line()
 			if choice == "n":
 				raise gptdo_exc.RefusedToRunCommand(f"Refused to run command: {command}")
-	
+
+def _execute_command(chatbot : GPTDoChatbot, command : str, stream_stdout_to_user=False, timeouts : tuple=(None, None)):
+	with tracing.span("command", command=command) as span:
+		return _run_process(chatbot, command, stream_stdout_to_user, span, timeouts)
+
+def _run_process(chatbot : GPTDoChatbot, command : str, stream_stdout_to_user : bool, span : tracing.Span, timeouts : tuple=(None, None)):
+	timeout, idle_timeout = timeouts
+	# Once the commands of the current prompt have been cancelled (e.g. from a daemon client), no others are started
+	if chatbot.cancel_commands.is_set():
+		raise gptdo_exc.CommandCancelled("Command cancelled")
+
 	chatbot.print(f"gptdo$ > `{command}`")
-	stdout = ""
-	stderr = ""
 
-	try:
-		process = subprocess.Popen(
-			command, 
-			shell=True,
-			executable="/bin/bash",
-			stdout=subprocess.PIPE, 
-			stderr=subprocess.PIPE, 
-			stdin=subprocess.PIPE, 
-			encoding="utf-8"
-		)
+	printer = _OutputPrinter(chatbot) if stream_stdout_to_user else None
+	# Input is only forwarded when the user can see the output (and so any prompt) of the command
+	forward_stdin = stream_stdout_to_user and not chatbot.raw_output and chatbot.forward_stdin
 
-		if not stream_stdout_to_user:
-			stdout, stderr = process.communicate()
+	try:
+		if chatbot.shell is not None:
+			result = chatbot.shell.run(command, on_output=printer, timeout=timeout, idle_timeout=idle_timeout, cancel=chatbot.cancel_commands)
 		else:
-			while True:
-				ln = process.stdout.readline()
-				if not ln and process.poll() is not None:
-					break
-				stdout += ln
-				chatbot.print(f"STDOUT >> {ln}", end="")
+			result = run_process(
+				command, on_output=printer, forward_stdin=forward_stdin, timeout=timeout, idle_timeout=idle_timeout,
+				limits=chatbot.resource_limits, cancel=chatbot.cancel_commands
+			)
 	except KeyboardInterrupt:
-		process.terminate()
 		raise gptdo_exc.CommandCancelled("Command cancelled")
+	finally:
+		if printer:
+			printer.finish()
+
+	result.log_metrics()
+	chatbot.command_metrics.append(result.metrics)
+	span.attributes.update(exit_code=result.exit_code, bytes_read=result.bytes_read, io_wait=result.io_wait, stopped=result.stopped)
+
+	if result.stopped == CANCELLED:
+		raise gptdo_exc.CommandCancelled("Command cancelled")
+
+	if result.stopped is not None:
+		limit = timeout if result.stopped == TIMEOUT else idle_timeout
+		raise gptdo_exc.CommandTimedOut(
+			f"Command timed out: {command}", result.stdout.text(), result.stderr.text(), result.exit_code,
+			result.stopped, result.wall_time, limit, captures=(result.stdout, result.stderr)
+		)
+
+	if result.exit_code != 0:
+		raise gptdo_exc.CommandFailed(f"Failed to run command: {command}", result.stdout.text(), result.stderr.text(), result.exit_code, captures=(result.stdout, result.stderr))
+
+	return result.stdout, result.stderr
+
+class _OutputPrinter:
+	"""Shows the interleaved stdout and stderr of a command as it arrives, prefixing each line with its stream
+
+	Partial lines are printed straight away, so that prompts which don't end in a newline are visible.
+	"""
+	def __init__(self, chatbot : GPTDoChatbot):
+		self.chatbot = chatbot
+		self._open_line : str = None
+
+	def __call__(self, stream : str, text : str, elapsed : float):
+		logger.debug(f"[+{elapsed:.3f}s] {stream.upper()}: {text!r}")
+
+		for line in text.splitlines(keepends=True):
+			if self._open_line is not None and self._open_line != stream:
+				self.finish()
 
-	if process.returncode != 0:
-		raise gptdo_exc.CommandFailed(f"Failed to run command: {command}", stdout, stderr, process.returncode)
+			prefix = f"{stream.upper()} >> " if self._open_line is None else ""
+			self.chatbot.print(prefix + line, end="", flush=True)
+			self._open_line = None if line.endswith("\n") else stream
 
-	return stdout, stderr
+	def finish(self):
+		if self._open_line is not None:
+			self.chatbot.print("")
+			self._open_line = None
@@ -0,0 +1,154 @@
+import os
+import re
+import sys
+import glob
+import threading
+import logging
+from . import environment, tracing
+
+logger = logging.getLogger("gptdo")
+
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+
+# Matches returned per name looked up
+MAX_MATCHES = 20
+
+def normalize(name : str) -> str:
+	"""Package names compare case-insensitively, and with -, _ and . all alike (as pip does)"""
+	return re.sub(r"[-_.]+", "-", name).lower()
+
+def _mtime(path : str) -> int:
+	try:
+		return os.stat(path).st_mtime_ns
+	except OSError:
+		return None
+
+
+class Inventory:
+	"""Names and versions of the installed packages, rebuilt only when what they are read from has changed
+
+	Python distributions are read with importlib.metadata from the site-packages of the user's active virtualenv (if
+	any) and the directories of sys.path, whose modification time changes whenever a distribution is installed,
+	upgraded or removed. System packages are read from the dpkg status database, if there is one.
+	"""
+	def __init__(self, status_path : str=DPKG_STATUS_PATH):
+		self.status_path = status_path
+		self._python : 'dict[str, tuple[str, str]]' = {}
+		self._python_key = None
+		self._system : 'dict[str, tuple[str, str]]' = {}
+		self._system_key = None
+		self._lock = threading.Lock()
+
+	def python_key(self) -> tuple:
+		return tuple((path, _mtime(path)) for path in python_paths())
+
+	def system_key(self):
+		return _mtime(self.status_path)
+
+	def key(self) -> tuple:
+		return (self.python_key(), self.system_key())
+
+	@property
+	def python(self) -> 'dict[str, tuple[str, str]]':
+		"""Normalized name => (name, version) of each Python distribution"""
+		key = self.python_key()
+		with self._lock:
+			if key != self._python_key:
+				with tracing.span("inventory.python"):
+					self._python = read_python_distributions([path for path, _ in key])
+				self._python_key = key
+
+			return self._python
+
+	@property
+	def system(self) -> 'dict[str, tuple[str, str]]':
+		"""Normalized name => (name, version) of each installed dpkg package"""
+		key = self.system_key()
+		with self._lock:
+			if key != self._system_key:
+				with tracing.span("inventory.system"):
+					self._system = read_dpkg_status(self.status_path) if key is not None else {}
+				self._system_key = key
+
+			return self._system
+
+	def summary(self) -> dict:
+		summary = { "python_distributions": len(self.python) }
+		if self.system:
+			summary["dpkg_packages"] = len(self.system)
+
+		return summary
+
+	def lookup(self, name : str, source : str="any") -> 'list[dict]':
+		"""The packages named `name`, or else (up to MAX_MATCHES of) those whose name contains it"""
+		wanted = normalize(name)
+		sources = [("python", self.python), ("system", self.system)]
+		matches = []
+		for source_name, packages in sources:
+			if source not in ["any", source_name]:
+				continue
+
+			if wanted in packages:
+				exact_name, version = packages[wanted]
+				matches.append({ "name": exact_name, "version": version, "source": source_name })
+				continue
+
+			for normalized in sorted(packages):
+				if wanted in normalized:
+					partial_name, version = packages[normalized]
+					matches.append({ "name": partial_name, "version": version, "source": source_name })
+
+		return matches[:MAX_MATCHES]
+
+
+def python_paths() -> 'list[str]':
+	paths = []
+	virtualenv = environment.environ().get("VIRTUAL_ENV")
+	if virtualenv:
+		paths += sorted(glob.glob(os.path.join(virtualenv, "lib", "python*", "site-packages")))
+
+	return paths + [path for path in sys.path if path and path not in paths and os.path.isdir(path)]
+
+def read_python_distributions(paths : 'list[str]') -> 'dict[str, tuple[str, str]]':
+	from importlib import metadata
+	distributions = {}
+	for distribution in metadata.distributions(path=paths):
+		name = distribution.metadata["Name"]
+		# The first distribution found on sys.path is the one imported, as with the modules themselves
+		if name and normalize(name) not in distributions:
+			distributions[normalize(name)] = (name, distribution.version)
+
+	return distributions
+
+def read_dpkg_status(path : str) -> 'dict[str, tuple[str, str]]':
+	"""The installed packages of a dpkg status file, which has a paragraph of `Field: value` lines per package"""
+	packages = {}
+	with open(path, "r", encoding="utf-8", errors="replace") as f:
+		fields = {}
+		for line in f:
+			if line.strip():
+				if not line[0].isspace():
+					field, _, value = line.partition(":")
+					fields[field] = value.strip()
+				continue
+
+			_add_dpkg_package(packages, fields)
+			fields = {}
+
+		_add_dpkg_package(packages, fields)
+
+	return packages
+
+def _add_dpkg_package(packages : dict, fields : dict):
+	if fields.get("Package") and fields.get("Status", "").endswith(" installed"):
+		packages[normalize(fields["Package"])] = (fields["Package"], fields.get("Version"))
+
+
+_inventory : Inventory = None
+
+def get_inventory() -> Inventory:
+	global _inventory
+	if _inventory is None:
+		_inventory = Inventory()
+
+	return _inventory
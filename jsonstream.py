@@ -0,0 +1,117 @@
+import json
+
+
+class IncrementalArgumentsParser:
+	"""Incrementally parses the JSON arguments of a function call as they are streamed in
+
+	`feed` returns the items of the `array_key` array which were completed by the given chunk, so they can be acted
+	on before the rest of the arguments arrive. Other top level values are stored in `values` as soon as they are complete.
+	"""
+	def __init__(self, array_key : str="commands"):
+		self.array_key = array_key
+		self.values : dict = {}
+		self.items : list = []
+
+		self._raw = ""
+		self._pos = 0
+		self._stack : 'list[str]' = []
+		self._in_string = False
+		self._escape = False
+		self._expect_key = False
+		self._key : str = None
+		self._in_array = False
+		# Start of the key, value or array item currently being read
+		self._token_start : int = None
+
+	@property
+	def _depth(self) -> int:
+		return len(self._stack)
+
+	def _tracked(self) -> bool:
+		return self._depth == 1 or (self._depth == 2 and self._in_array)
+
+	def feed(self, chunk : str) -> list:
+		self._raw += chunk
+		completed = []
+
+		while self._pos < len(self._raw):
+			i = self._pos
+			c = self._raw[i]
+			self._pos += 1
+
+			if self._in_string:
+				if self._escape:
+					self._escape = False
+				elif c == "\\":
+					self._escape = True
+				elif c == '"':
+					self._in_string = False
+					self._end_string(i, completed)
+				continue
+
+			if c == '"':
+				self._in_string = True
+				if self._tracked() and self._token_start is None:
+					self._token_start = i
+
+			elif c in "{[":
+				if self._depth == 1 and not self._expect_key and self._token_start is None and c == "[" and self._key == self.array_key:
+					self._in_array = True
+				elif self._tracked() and self._token_start is None:
+					self._token_start = i
+
+				self._stack.append(c)
+				if self._depth == 1:
+					self._expect_key = True
+
+			elif c in "}]":
+				self._flush_scalar(i, completed)
+				self._stack.pop()
+
+				if self._depth == 1 and self._in_array:
+					self._in_array = False
+					self.values[self.array_key] = list(self.items)
+				elif self._tracked() and self._token_start is not None:
+					self._complete(self._raw[self._token_start:i + 1], completed)
+
+			elif c == ",":
+				self._flush_scalar(i, completed)
+				if self._depth == 1:
+					self._expect_key = True
+
+			elif c == ":":
+				if self._depth == 1:
+					self._expect_key = False
+
+			elif not c.isspace() and self._tracked() and self._token_start is None:
+				self._token_start = i
+
+		return completed
+
+	def _end_string(self, i : int, completed : list):
+		if not self._tracked() or self._token_start is None or self._raw[self._token_start] != '"':
+			return
+
+		token = self._raw[self._token_start:i + 1]
+		if self._depth == 1 and self._expect_key:
+			self._key = json.loads(token)
+			self._token_start = None
+		else:
+			self._complete(token, completed)
+
+	def _flush_scalar(self, i : int, completed : list):
+		"""Completes a number, boolean or null, which only end when the next delimiter is seen"""
+		if not self._tracked() or self._token_start is None or self._raw[self._token_start] in '"{[':
+			return
+
+		self._complete(self._raw[self._token_start:i].strip(), completed)
+
+	def _complete(self, token : str, completed : list):
+		self._token_start = None
+		value = json.loads(token)
+
+		if self._depth == 2 and self._in_array:
+			self.items.append(value)
+			completed.append(value)
+		else:
+			self.values[self._key] = value
@@ -0,0 +1,111 @@
+import difflib
+import logging
+import threading
+from collections import OrderedDict
+from .capture import OutputCapture
+
+logger = logging.getLogger("gptdo")
+
+# Outputs shorter than this are always sent as they are, as a reference to them wouldn't be much shorter
+MIN_DEDUP_CHARS = 200
+
+# A command's output is sent as a diff from its previous output only if the diff is at most this fraction of its size
+MAX_DIFF_RATIO = 0.5
+
+# Characters of output kept to compare new outputs against (and to read back), least recently used first
+MAX_STORED_CHARS = 4 * 1024 * 1024
+
+
+class OutputStore:
+	"""The outputs of the commands run in a session, addressed by the hash of their content
+
+	An output which is byte-identical to an earlier one is sent to the model as a reference to it, and the output of a
+	command run again which only changed slightly as a unified diff from its previous output. Outputs are numbered with
+	their output_id, so that the model can still read the earlier output with `read_command_output` once it has been
+	elided from the conversation.
+	"""
+	def __init__(self, max_chars : int=MAX_STORED_CHARS):
+		self.max_chars = max_chars
+		self.deduplicated = 0
+		self.bytes_saved = 0
+
+		# output_id -> (capture, text as sent to the model)
+		self._outputs : 'OrderedDict[int, tuple[OutputCapture, str]]' = OrderedDict()
+		self._chars = 0
+		self._by_digest : 'dict[str, int]' = {}
+		# (command, stream) -> output_id of its latest output
+		self._latest : 'dict[tuple[str, str], int]' = {}
+		self._lock = threading.RLock()
+
+	def get(self, output_id : int) -> OutputCapture:
+		with self._lock:
+			stored = self._outputs.get(output_id)
+			if stored is None:
+				return None
+
+			if not stored[0].readable:
+				logger.info(f"The spilled output #{output_id} was deleted, forgetting it")
+				self._evict(output_id)
+				return None
+
+			return stored[0]
+
+	def add(self, command : str, capture : OutputCapture) -> str:
+		"""Stores the output of `command`, returning what to send to the model in its place"""
+		text = capture.text()
+		if len(text) < MIN_DEDUP_CHARS:
+			return text
+
+		key = (command, capture.name)
+		with self._lock:
+			original = self._by_digest.get(capture.digest)
+			if original is not None and self.get(original) is not None:
+				self._outputs.move_to_end(original)
+				self._latest[key] = original
+				return self._saved(text, f"[{capture.name} identical to output #{original}]\n", command)
+
+			previous = self._latest.get(key)
+			previous_text = self._outputs[previous][1] if previous in self._outputs else None
+			self._store(capture, text)
+			self._latest[key] = capture.id
+
+		labelled = f"[output #{capture.id}]\n{text}"
+		if previous_text is None:
+			return labelled
+
+		diff = "".join(difflib.unified_diff(
+			previous_text.splitlines(keepends=True),
+			text.splitlines(keepends=True),
+			fromfile=f"output #{previous}",
+			tofile=f"output #{capture.id}",
+			n=1
+		))
+		if len(diff) > len(text) * MAX_DIFF_RATIO:
+			return labelled
+
+		return self._saved(text, f"[output #{capture.id}: {capture.name} changed from output #{previous}]\n{diff}", command)
+
+	def _store(self, capture : OutputCapture, text : str):
+		self._outputs[capture.id] = (capture, text)
+		self._by_digest[capture.digest] = capture.id
+		self._chars += len(text)
+
+		while self._chars > self.max_chars and len(self._outputs) > 1:
+			self._evict(next(iter(self._outputs)))
+
+	def _evict(self, output_id : int):
+		evicted, evicted_text = self._outputs.pop(output_id)
+		self._chars -= len(evicted_text)
+		if self._by_digest.get(evicted.digest) == output_id:
+			del self._by_digest[evicted.digest]
+
+	def _saved(self, text : str, replacement : str, command : str) -> str:
+		saved = len(text.encode("utf-8", errors="replace")) - len(replacement.encode("utf-8", errors="replace"))
+		with self._lock:
+			self.deduplicated += 1
+			self.bytes_saved += saved
+		logger.info(f"Sent a reference instead of the output of `{command}`: {saved} bytes saved, {self.bytes_saved} over the session")
+		return replacement
+
+	def summary(self) -> str:
+		return f"Command outputs: {self.deduplicated} deduplicated, {self.bytes_saved} bytes saved\n"
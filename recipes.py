@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import platform
+from collections import Counter
+from . import ROOT, environment
+
+logger = logging.getLogger("gptdo")
+
+RECIPES_PATH = os.path.join(ROOT, "recipes.sqlite")
+
+DEFAULT_MAX_RECIPES = 500
+# Recipes not used (or recorded again) for this long are dropped
+DEFAULT_TTL = 90 * 24 * 60 * 60
+
+# Cosine similarity from which a recipe is offered instead of asking the model
+MIN_SIMILARITY = 0.7
+# Recipes recorded in another directory may depend on it (e.g. relative paths), so they need a closer match
+OTHER_CWD_PENALTY = 0.85
+
+WORD = re.compile(r"[a-z0-9]+")
+
+# Words which say nothing about the task
+STOP_WORDS = {
+	"a", "an", "the", "to", "of", "in", "on", "for", "and", "or", "is", "are", "be", "do", "does", "i", "me", "my", "we",
+	"our", "you", "can", "could", "please", "what", "which", "how", "this", "that", "all", "some", "with", "from", "it",
+}
+
+def words(prompt : str) -> 'list[str]':
+	return [word for word in WORD.findall(prompt.lower()) if word not in STOP_WORDS]
+
+def normalize(prompt : str) -> str:
+	return " ".join(words(prompt))
+
+def features(prompt : str) -> 'Counter[str]':
+	"""Words, and the character trigrams of each word at half weight, so that "port" still matches "ports" """
+	counts = Counter()
+	for word in words(prompt):
+		counts[word] += 1.0
+		padded = f" {word} "
+		for i in range(len(padded) - 2):
+			counts["#" + padded[i:i + 3]] += 0.5
+
+	return counts
+
+def os_fingerprint() -> str:
+	distribution = ""
+	try:
+		with open("/etc/os-release", "r") as f:
+			distribution = next((line.split("=", 1)[1].strip().strip('"') for line in f if line.startswith("ID=")), "")
+	except OSError:
+		pass
+
+	return f"{platform.system()} {distribution} {platform.machine()}".replace("  ", " ")
+
+
+class RecipeIndex:
+	"""Prompts whose commands all ran successfully, to offer the same commands when a similar prompt is asked again
+
+	Recipes are only matched against those recorded on the same OS, with a TF-IDF cosine similarity over the words of
+	the prompts (and their character trigrams). They expire after `ttl` seconds without being used, and the least
+	recently used ones are evicted past `max_recipes`.
+	"""
+	def __init__(self, path : str=RECIPES_PATH, ttl : float=DEFAULT_TTL, max_recipes : int=DEFAULT_MAX_RECIPES, min_similarity : float=MIN_SIMILARITY):
+		self.path = path
+		self.ttl = ttl
+		self.max_recipes = max_recipes
+		self.min_similarity = min_similarity
+		self._db : sqlite3.Connection = None
+
+	@property
+	def db(self) -> sqlite3.Connection:
+		if self._db is None:
+			self._db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+			self._db.execute("PRAGMA journal_mode=WAL")
+			self._db.execute("""
+				CREATE TABLE IF NOT EXISTS recipes (
+					key TEXT PRIMARY KEY,
+					prompt TEXT NOT NULL,
+					os TEXT NOT NULL,
+					cwd TEXT NOT NULL,
+					commands TEXT NOT NULL,
+					uses INTEGER NOT NULL,
+					created REAL NOT NULL,
+					last_used REAL NOT NULL
+				)
+			""")
+			self._db.execute("CREATE INDEX IF NOT EXISTS recipes_os ON recipes (os)")
+
+		return self._db
+
+	@staticmethod
+	def key(prompt : str, os_name : str, cwd : str, commands : 'list[str]') -> str:
+		payload = json.dumps([normalize(prompt), os_name, cwd, commands])
+		return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+	def record(self, prompt : str, commands : 'list[str]'):
+		now = time.time()
+		os_name, cwd = os_fingerprint(), environment.getcwd()
+		self.db.execute("""
+			INSERT INTO recipes (key, prompt, os, cwd, commands, uses, created, last_used) VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+			ON CONFLICT (key) DO UPDATE SET uses = uses + 1, last_used = excluded.last_used
+		""", (self.key(prompt, os_name, cwd, commands), prompt, os_name, cwd, json.dumps(commands), now, now))
+		self.evict()
+
+	def forget(self, key : str):
+		self.db.execute("DELETE FROM recipes WHERE key = ?", (key,))
+
+	def match(self, prompt : str) -> 'dict':
+		"""The recipe most similar to `prompt`, if it is similar enough, with its `similarity`"""
+		rows = self.db.execute(
+			"SELECT key, prompt, cwd, commands, uses FROM recipes WHERE os = ? AND last_used >= ?",
+			(os_fingerprint(), time.time() - self.ttl)
+		).fetchall()
+		if not rows:
+			return None
+
+		documents = [features(row[1]) for row in rows]
+		query = features(prompt)
+
+		# Smoothed inverse document frequencies over the recipes
+		frequencies = Counter(feature for document in documents for feature in document)
+		def idf(feature : str) -> float:
+			return math.log((len(documents) + 1) / (frequencies[feature] + 1)) + 1
+
+		def vector(counts : 'Counter[str]') -> 'dict[str, float]':
+			weights = { feature: count * idf(feature) for feature, count in counts.items() }
+			norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+			return { feature: w / norm for feature, w in weights.items() }
+
+		query_vector = vector(query)
+		cwd = environment.getcwd()
+		best, best_similarity = None, 0.0
+		for row, document in zip(rows, documents):
+			similarity = sum(w * query_vector.get(feature, 0.0) for feature, w in vector(document).items())
+			if row[2] != cwd:
+				similarity *= OTHER_CWD_PENALTY
+
+			if similarity > best_similarity:
+				best, best_similarity = row, similarity
+
+		if best is None:
+			return None
+
+		logger.debug(f"Closest recipe: {best[1]!r} ({best_similarity:.2f} similar, {len(rows)} recipes)")
+		if best_similarity < self.min_similarity:
+			return None
+
+		key, recipe_prompt, recipe_cwd, commands, uses = best
+		return { "key": key, "prompt": recipe_prompt, "cwd": recipe_cwd, "commands": json.loads(commands), "uses": uses, "similarity": best_similarity }
+
+	def evict(self):
+		db = self.db
+		db.execute("DELETE FROM recipes WHERE last_used < ?", (time.time() - self.ttl,))
+		evicted = db.execute(
+			"DELETE FROM recipes WHERE key NOT IN (SELECT key FROM recipes ORDER BY last_used DESC LIMIT ?)",
+			(self.max_recipes,)
+		).rowcount
+		if evicted:
+			logger.debug(f"Evicted {evicted} recipes")
+
+	def close(self):
+		if self._db is not None:
+			self._db.close()
+			self._db = None
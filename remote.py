@@ -0,0 +1,53 @@
+import queue
+import logging
+import threading
+from typing import TYPE_CHECKING
+from .chatbot import GPTDoChatbot
+
+if TYPE_CHECKING:
+	from .daemon import Connection
+
+logger = logging.getLogger("gptdo")
+
+class RemoteChatbot(GPTDoChatbot):
+	"""A chatbot whose terminal is a client connected to the daemon
+
+	The client's messages are read by a thread of their own, so that an interrupt (or the client disconnecting) is seen
+	while a command runs, and stops it as Ctrl-C does in a standalone session.
+	"""
+	def __init__(self, connection : 'Connection', **kwargs):
+		super().__init__(**kwargs)
+		self.connection = connection
+		# The daemon's own stdin isn't the client's terminal, and input is only relayed at prompts
+		self.forward_stdin = False
+		self._replies : 'queue.Queue[dict]' = queue.Queue()
+		threading.Thread(target=self._read, name="gptdo-session-reader", daemon=True).start()
+
+	def _read(self):
+		while True:
+			try:
+				message = self.connection.receive()
+			except (OSError, ValueError):
+				message = None
+
+			if message is None or message["type"] == "interrupt":
+				logger.info("Client interrupted the session" if message else "Client disconnected, stopping its commands")
+				self.cancel_commands.set()
+
+			if message is None:
+				self._replies.put(None)
+				return
+
+			if message["type"] != "interrupt":
+				self._replies.put(message)
+
+	def write(self, text : str, stream : str="stdout"):
+		self.connection.send("output", stream=stream, text=text)
+
+	def input(self, prompt : str) -> str:
+		self.connection.send("input", prompt=prompt)
+		message = self._replies.get()
+		if message is None or message["type"] != "input":
+			raise EOFError()
+
+		return message["text"]
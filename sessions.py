@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+from contextlib import contextmanager
+from . import ROOT, environment
+from .exceptions import SessionNotFound
+
+logger = logging.getLogger("gptdo")
+
+SESSIONS_DIR = os.path.join(ROOT, "sessions")
+
+# One line per update of a session, the latest of which describes it. Rewritten with one line per session when sessions
+# are pruned, or once it grows past INDEX_COMPACT_BYTES
+INDEX_PATH = os.path.join(SESSIONS_DIR, "index.jsonl")
+INDEX_COMPACT_BYTES = 256 * 1024
+
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+# Characters of a session's first prompt used as its title
+MAX_TITLE_CHARS = 60
+
+def session_path(session_id : str) -> str:
+	return os.path.join(SESSIONS_DIR, session_id + ".jsonl")
+
+@contextmanager
+def _locked_index():
+	"""Serializes updates of the index between sessions, which may be in other processes"""
+	os.makedirs(SESSIONS_DIR, mode=0o700, exist_ok=True)
+	with open(INDEX_PATH + ".lock", "a") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class SessionLog:
+	"""Persists a conversation's messages as they are added, one JSON line each, after a header line describing the session
+
+	The file is only ever appended to, so a session interrupted at any point loses at most the message being written.
+	Nothing is written until the first message, so sessions left without a prompt aren't kept.
+	"""
+	def __init__(self, session_id : str, messages : int=0, title : str=None, header : dict=None):
+		self.id = session_id
+		self.path = session_path(session_id)
+		self.messages = messages
+		self.title = title
+		self._header = header
+		self._file = None
+
+	@classmethod
+	def create(cls, model : str, context_files : list=None) -> 'SessionLog':
+		session_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+		return cls(session_id, header={
+			"session": session_id,
+			"created": time.time(),
+			"cwd": environment.getcwd(),
+			"model": model,
+			"context_files": context_files,
+		})
+
+	def append(self, message : dict):
+		if self._header is not None:
+			self._write(self._header)
+			self._header = None
+
+		self._write(message)
+		self.messages += 1
+		if self.title is None and message["role"] == "user":
+			self.title = " ".join(message["content"].split())[:MAX_TITLE_CHARS]
+
+		self._update_index()
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def _write(self, entry : dict):
+		if self._file is None:
+			os.makedirs(SESSIONS_DIR, mode=0o700, exist_ok=True)
+			self._file = open(os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), "a")
+
+		self._file.write(json.dumps(entry) + "\n")
+		self._file.flush()
+
+	def _update_index(self):
+		entry = {
+			"id": self.id,
+			"updated": time.time(),
+			"messages": self.messages,
+			"size": self._file.tell(),
+			"title": self.title,
+			"cwd": environment.getcwd(),
+		}
+		try:
+			with _locked_index():
+				with open(INDEX_PATH, "a") as index:
+					index.write(json.dumps(entry) + "\n")
+					size = index.tell()
+
+				if size > INDEX_COMPACT_BYTES:
+					sessions = list_sessions()
+					_write_index(sessions)
+					logger.debug(f"Compacted the session index from {size} bytes to {len(sessions)} sessions")
+		except OSError as e:
+			logger.warning(f"Could not update the session index: {e}")
+
+
+def _write_index(sessions : 'list[dict]'):
+	"""Replaces the index with one line per session. Must be called with the index locked"""
+	with open(INDEX_PATH + ".tmp", "w") as index:
+		index.writelines(json.dumps(s) + "\n" for s in sessions)
+	os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
+
+def load(session_id : str) -> 'tuple[dict, list[dict]]':
+	"""The header and messages of a session. A partly written last line (from an interrupted write) is skipped"""
+	path = session_path(session_id)
+	if not os.path.exists(path):
+		raise SessionNotFound(f"No session {session_id} in {SESSIONS_DIR}")
+
+	with open(path, "r") as f:
+		lines = f.read().splitlines()
+
+	header, messages = json.loads(lines[0]), []
+	for line in lines[1:]:
+		try:
+			messages.append(json.loads(line))
+		except json.JSONDecodeError:
+			logger.warning(f"Skipping a truncated message of session {session_id}")
+
+	return header, messages
+
+def list_sessions() -> 'list[dict]':
+	"""Every session in the index which still has a file, the most recently updated last"""
+	sessions : 'dict[str, dict]' = {}
+	if os.path.exists(INDEX_PATH):
+		with open(INDEX_PATH, "r") as index:
+			for line in index:
+				try:
+					entry = json.loads(line)
+				except json.JSONDecodeError:
+					continue
+
+				sessions[entry["id"]] = entry
+
+	return sorted((s for s in sessions.values() if os.path.exists(session_path(s["id"]))), key=lambda s: s["updated"])
+
+def resolve(session_id : str) -> str:
+	"""The id of the latest session for "latest", or of the only session starting with `session_id`"""
+	if session_id == "latest":
+		listed = list_sessions()
+		if not listed:
+			raise SessionNotFound("There is no session to resume")
+		return listed[-1]["id"]
+
+	if os.path.exists(session_path(session_id)):
+		return session_id
+
+	matches = [s["id"] for s in list_sessions() if s["id"].startswith(session_id)]
+	if len(matches) != 1:
+		raise SessionNotFound(f"{'No' if not matches else 'More than one'} session matching {session_id}")
+
+	return matches[0]
+
+def resume(session_id : str) -> 'tuple[SessionLog, dict, list[dict]]':
+	"""Reopens a session, to which new messages are appended"""
+	session_id = resolve(session_id)
+	header, messages = load(session_id)
+	title = next((" ".join(m["content"].split())[:MAX_TITLE_CHARS] for m in messages if m["role"] == "user"), None)
+	return SessionLog(session_id, messages=len(messages), title=title), header, messages
+
+def prune(max_age : float=DEFAULT_MAX_AGE_DAYS * 24 * 60 * 60, max_bytes : int=DEFAULT_MAX_BYTES) -> 'list[dict]':
+	"""Deletes the sessions not updated for `max_age` seconds, then the oldest ones until the rest fit in `max_bytes`
+
+	Returns the sessions deleted. The index is rewritten with one line per remaining session.
+	"""
+	with _locked_index():
+		sessions = list_sessions()
+		now = time.time()
+		total = sum(s["size"] for s in sessions)
+
+		deleted = []
+		for session in sessions:
+			if now - session["updated"] > max_age or total > max_bytes:
+				try:
+					os.remove(session_path(session["id"]))
+				except FileNotFoundError:
+					pass
+
+				total -= session["size"]
+				deleted.append(session)
+
+		remaining = [s for s in sessions if s not in deleted]
+		_write_index(remaining)
+
+	logger.info(f"Pruned {len(deleted)} sessions, {len(remaining)} remaining")
+	return deleted
+
+def format_sessions(sessions : 'list[dict]') -> str:
+	lines = []
+	for s in sessions:
+		updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(s["updated"]))
+		lines.append(f"{s['id']}  {updated}  {s['messages']:>4} messages  {s['size'] / 1024:>7.1f}KB  {s.get('title') or ''}")
+
+	return "\n".join(lines)
@@ -0,0 +1,42 @@
+import os
+import sys
+import importlib
+
+# The repository is itself the package, so it's imported by its directory name (as in benchmarks/_common.py)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(REPO_DIR))
+os.makedirs(os.path.join(os.path.expanduser("~"), ".gptdo"), exist_ok=True)
+compaction = importlib.import_module(f"{os.path.basename(REPO_DIR)}.compaction")
+
+def tool_call(call_id : str, command : str) -> dict:
+	return { "id": call_id, "type": "function", "function": { "name": "run_commands", "arguments": f'{{"commands": ["{command}"]}}' } }
+
+def test_truncates_latest_tool_result():
+	output = "\n".join(f"line {i} of a very long command output" for i in range(5000))
+	messages = [
+		{ "role": "system", "content": "You are gptdo." },
+		{ "role": "user", "content": "Show the logs" },
+		{ "role": "assistant", "content": None, "tool_calls": [tool_call("call_0", "cat app.log")] },
+		{ "role": "tool", "tool_call_id": "call_0", "content": output },
+	]
+
+	window = compaction.compact(messages, budget=2000, strategies=[compaction.TruncateLargeMessages()])
+
+	assert compaction.count_messages_tokens(window) <= 2000
+	assert "characters elided" in window[-1]["content"]
+	assert window[-1]["content"].startswith("line 0 ") and window[-1]["content"].endswith("line 4999 of a very long command output")
+	assert messages[-1]["content"] == output
+
+def test_drops_tool_results_with_their_call():
+	output = "\n".join(f"line {i} of a very long command output" for i in range(50000))
+	messages = [
+		{ "role": "system", "content": "You are gptdo." },
+		{ "role": "user", "content": "Show the logs" },
+		{ "role": "assistant", "content": None, "tool_calls": [tool_call("call_0", "cat app.log")] },
+		{ "role": "tool", "tool_call_id": "call_0", "content": output },
+	]
+
+	window = compaction.compact(messages, budget=5000, strategies=[compaction.DropOldestMessages()])
+
+	assert compaction.count_messages_tokens(window) <= 5000
+	assert [m["role"] for m in window] == ["system", "assistant", "tool"]
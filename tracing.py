@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from . import ROOT
+
+logger = logging.getLogger("gptdo")
+
+TRACE_PATH = os.path.join(ROOT, "trace.jsonl")
+
+# The trace file is rotated to trace.jsonl.1 once it grows past this size
+MAX_TRACE_BYTES = 10 * 1024 * 1024
+
+_write_lock = threading.Lock()
+
+class Span:
+	"""A timed phase of a turn, e.g. generating the context, waiting on the API or running a command"""
+	__slots__ = ("id", "name", "turn", "parent", "attributes", "start", "end", "thread")
+
+	def __init__(self, name : str, turn : int, parent : 'Span', attributes : dict):
+		self.id = uuid.uuid4().hex[:16]
+		self.name = name
+		self.turn = turn
+		self.parent = parent.id if parent else None
+		self.attributes = attributes
+		self.start = time.perf_counter()
+		self.end : float = None
+		self.thread = threading.current_thread().name
+
+	@property
+	def duration(self) -> float:
+		return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Tracer:
+	"""Records the spans of a conversation, turn by turn
+
+	Spans are recorded by the `span` context manager, into the tracer of the turn it is called from (which carries
+	over to work handed to pools with `contextvars.copy_context`). Each turn's spans are appended to the trace file
+	once the turn is over.
+	"""
+	def __init__(self, path : str=TRACE_PATH):
+		self.path = path
+		self.session = uuid.uuid4().hex[:12]
+		self.turn = 0
+		self.spans : 'list[Span]' = []
+		self._flushed = 0
+		# Offset between perf_counter and wall clock time, to write absolute timestamps
+		self._epoch = time.time() - time.perf_counter()
+
+	@contextmanager
+	def trace_turn(self, **attributes):
+		self.turn += 1
+		tracer_token = _current_tracer.set(self)
+		try:
+			with span("turn", **attributes) as turn:
+				yield turn
+		finally:
+			_current_tracer.reset(tracer_token)
+			self.flush()
+
+	def record(self, span : Span):
+		self.spans.append(span)
+
+	def flush(self):
+		"""Appends the spans recorded since the last flush to the trace file"""
+		spans, self._flushed = self.spans[self._flushed:], len(self.spans)
+		if not spans or not self.path:
+			return
+
+		lines = "".join(json.dumps({
+			"session": self.session,
+			"turn": s.turn,
+			"id": s.id,
+			"parent": s.parent,
+			"name": s.name,
+			"start": self._epoch + s.start,
+			"duration_ms": s.duration * 1000,
+			"thread": s.thread,
+			**s.attributes,
+		}, default=str) + "\n" for s in spans)
+
+		try:
+			with _write_lock:
+				if os.path.exists(self.path) and os.path.getsize(self.path) > MAX_TRACE_BYTES:
+					os.replace(self.path, self.path + ".1")
+
+				with open(self.path, "a") as f:
+					f.write(lines)
+		except OSError as e:
+			logger.warning(f"Could not write trace to {self.path}: {e}")
+
+	def report(self) -> str:
+		"""A per-turn breakdown of the time spent in each phase, and of the tokens used"""
+		output = "Profile:\n"
+		for turn in range(1, self.turn + 1):
+			spans = [s for s in self.spans if s.turn == turn]
+			root = next((s for s in spans if s.name == "turn"), None)
+			completions = [s for s in spans if s.name == "completion"]
+			prompt_tokens = sum(s.attributes.get("prompt_tokens") or 0 for s in completions)
+			completion_tokens = sum(s.attributes.get("completion_tokens") or 0 for s in completions)
+			cached_tokens = sum(s.attributes.get("cached_tokens") or 0 for s in completions)
+
+			total = f"{root.duration * 1000:.0f}ms" if root else "?"
+			tool_calls = sum(s.attributes.get("tool_calls") or 0 for s in completions)
+			output += f"\nTurn {turn}: {total}, {len(completions)} round trips ({tool_calls} tool calls), {prompt_tokens} prompt ({cached_tokens} cached) + {completion_tokens} completion tokens\n"
+
+			phases : 'dict[str, list[float]]' = {}
+			for s in spans:
+				if s is not root:
+					phases.setdefault(s.name, []).append(s.duration)
+
+			for name, durations in sorted(phases.items(), key=lambda phase: -sum(phase[1])):
+				output += f"  {name:<24} {len(durations):>4} x {sum(durations) * 1000:>9.1f}ms\n"
+
+		return output
+
+
+_current_tracer : 'ContextVar[Tracer]' = ContextVar("gptdo_tracer", default=None)
+_current_span : 'ContextVar[Span]' = ContextVar("gptdo_span", default=None)
+
+@contextmanager
+def span(name : str, **attributes):
+	"""Times the enclosed block as a span of the current turn. Attributes can be added to the yielded span as it runs
+
+	Outside of a traced turn the span is still yielded, but not recorded.
+	"""
+	tracer = _current_tracer.get()
+	current = Span(name, tracer.turn if tracer else 0, _current_span.get(), attributes)
+	span_token = _current_span.set(current)
+	try:
+		yield current
+	finally:
+		current.end = time.perf_counter()
+		_current_span.reset(span_token)
+		if tracer is not None:
+			tracer.record(current)
+
+def annotate(**attributes):
+	"""Adds attributes to the innermost span being recorded"""
+	current = _current_span.get()
+	if current is not None:
+		current.attributes.update(attributes)
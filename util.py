@@ -1,7 +1,7 @@
 
 import math
 from textwrap import indent, wrap
-from shutil import get_terminal_size
+from .environment import terminal_size as get_terminal_size
 
 
 def format_for_console(content : str, left_margin : int = 0, right_margin : int = 0):
@@ -66,9 +66,11 @@ def auto_detect_best_margins(content : str, position : str = "left") -> 'tuple[i
 
 	return (end_margin, start_margin)
 
+def clear_previous_line_sequence() -> str:
+	return "\033[F" + " " * get_terminal_size()[0] + "\r"
+
 def clear_and_return_to_previous_line():
-	print("\033[F", end="")
-	print(" " * get_terminal_size()[0], end="\r")
+	print(clear_previous_line_sequence(), end="")
 
 
 def format_message(message : dict) -> str:
@@ -80,7 +82,7 @@ def format_message(message : dict) -> str:
 	if role == "function":
 		role_name = f"Function `{message['name']}`"
 
-	content = message["content"]
+	content = message["content"] or ""
 	margins = auto_detect_best_margins(content, position=position)
 
 	if position == "right":
@@ -90,6 +92,53 @@ def format_message(message : dict) -> str:
 		[role_name, format_for_console(content, *margins)]
 	)
 
+class StreamFormatter:
+	"""Word-wraps a message as it is streamed in, using the same margin logic as `format_message`
+
+	The final length of a streamed message isn't known up front, so the margins are picked as if it were long.
+	"""
+	def __init__(self, role : str, position : str = "left"):
+		terminal_width = get_terminal_size()[0]
+		self.margins = auto_detect_best_margins("-" * terminal_width * 6, position=position)
+		self.width = max(terminal_width - sum(self.margins), 1)
+		self.role_name = role.capitalize() + " "
+
+		self._buffer = ""
+		self._column = 0
+
+	def start(self) -> str:
+		return self.role_name + "\n" + " " * self.margins[0]
+
+	def feed(self, text : str) -> str:
+		"""Returns the formatted output for every complete word received so far"""
+		self._buffer += text
+		last_space = max(self._buffer.rfind(" "), self._buffer.rfind("\n"), self._buffer.rfind("\t"))
+		if last_space < 0:
+			return ""
+
+		complete, self._buffer = self._buffer[:last_space], self._buffer[last_space + 1:]
+		return self._place(complete.split())
+
+	def finish(self) -> str:
+		output = self._place(self._buffer.split())
+		self._buffer = ""
+		return output
+
+	def _place(self, words : 'list[str]') -> str:
+		output = ""
+		for word in words:
+			if self._column == 0:
+				output += word
+				self._column = len(word)
+			elif self._column + 1 + len(word) <= self.width:
+				output += " " + word
+				self._column += 1 + len(word)
+			else:
+				output += "\n" + " " * self.margins[0] + word
+				self._column = len(word)
+
+		return output
+
 if __name__ == "__main__":
 	sample_very_short = "Here's a very short piece of text."
 	sample_short = "Here's a short piece of text. It should limit itself to 1-3 lines depending on terminal size."